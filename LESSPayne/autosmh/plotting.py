@@ -103,7 +103,7 @@ def get_feh_values(tab):
 
 def plot_spectrum(spec, wlmin=None, wlmax=None, ax=None,
                   dxmaj=None, dxmin=None, dymaj=None, dymin=None,
-                  fillcolor="#cccccc",fillalpha=1,
+                  fillcolor="#cccccc",fillalpha=1, rasterized=False,
                   **kwargs):
     if ax is None:
         fig, ax = plt.subplots()
@@ -122,8 +122,9 @@ def plot_spectrum(spec, wlmin=None, wlmax=None, ax=None,
     y1 = flux-errs
     y2 = flux+errs
 
-    fill_between_steps(ax, wave, y1, y2, alpha=fillalpha, facecolor=fillcolor, edgecolor=fillcolor)
-    ax.plot(wave, flux, **kwargs)
+    fill_between_steps(ax, wave, y1, y2, alpha=fillalpha, facecolor=fillcolor, edgecolor=fillcolor,
+                       rasterized=rasterized)
+    ax.plot(wave, flux, rasterized=rasterized, **kwargs)
 
     ax.xaxis.set_major_formatter(ScalarFormatter(useOffset=False))
     if dxmaj is not None: ax.xaxis.set_major_locator(MultipleLocator(dxmaj))
@@ -177,8 +178,11 @@ def _get_rv(plotmodel, named_p_opt):
             
             
 def plot_model_fit(ax, session, imodel, label=None, linewave=None,
-                   inset_dwl=None):
-    """ Plot SMH model fit """
+                   inset_dwl=None, rasterized=False):
+    """
+    Plot SMH model fit
+    If rasterized, the spectrum and model are rasterized (text and axes stay vector)
+    """
     if imodel is None: return
     try:
         plotmodel = session.spectral_models[imodel]
@@ -199,13 +203,13 @@ def plot_model_fit(ax, session, imodel, label=None, linewave=None,
         species = transition["species"]
         wave = transition["wavelength"]
     
-    plot_spectrum(spectrum, wlmin=w1, wlmax=w2, ax=ax, lw=3, color='k')
+    plot_spectrum(spectrum, wlmin=w1, wlmax=w2, ax=ax, lw=3, color='k', rasterized=rasterized)
     try:
         named_p_opt, cov, meta = plotmodel.metadata["fitted_result"]
         ax.set(ylim=(0,1.1), xlim=(w1,w2))
         modelcolor = "r" if plotmodel.is_acceptable else "b"
         modelx, modely = meta["model_x"], meta["model_y"]
-        ax.plot(modelx, modely, '-', lw=2, color=modelcolor)
+        ax.plot(modelx, modely, '-', lw=2, color=modelcolor, rasterized=rasterized)
         try:
             vrad = _get_rv(plotmodel, named_p_opt)
         except:
@@ -433,10 +437,8 @@ def plot_one_grid(smh_fname, OUTDIR="./"):
     assert smh_fname.endswith(".smh"), f"{smh_fname} is not an SMH file"
     assert os.path.exists(smh_fname), f"{smh_fname} does not exist"
     
-    if not os.path.exists(OUTDIR+"abund_data"):
-        os.makedirs(OUTDIR+"abund_data")
-    if not os.path.exists(OUTDIR+"abundstamp"):
-        os.makedirs(OUTDIR+"abundstamp")
+    os.makedirs(OUTDIR+"abund_data", exist_ok=True)
+    os.makedirs(OUTDIR+"abundstamp", exist_ok=True)
 
     name = os.path.basename(smh_fname)[:-4]
     
@@ -1,7 +1,9 @@
 import numpy as np
 import sys, os, time
+import json, logging
 import yaml
-from copy import deepcopy
+from hashlib import md5
+from shutil import rmtree
 from scipy.ndimage import gaussian_filter1d
 
 from LESSPayne.smh import Session, utils
@@ -9,16 +11,41 @@ from LESSPayne.specutils import Spectrum1D
 from LESSPayne.smh.spectral_models import ProfileFittingModel, SpectralSynthesisModel
 from LESSPayne.smh.photospheres.abundances import asplund_2009 as solar_composition
 from LESSPayne.PayneEchelle.spectral_model import DefaultPayneModel
+from LESSPayne.utils import num_workers
 
 from .plotting import plot_summary_1, plot_summary_2, plot_model_fit, get_line_table, plot_fe_trends
 
-def run_eqw_fit(cfg):
+timing_logger = logging.getLogger("eqwfit.timing")
+
+class Timer(object):
+    """
+    Context manager that times a step with time.perf_counter.
+    On entry and exit it logs a JSON record ({"step", "event", "elapsed"}) to
+    the "eqwfit.timing" logger, so a FileHandler on that logger gives a JSONL
+    profile of every run. The elapsed time (s) is also kept in Timer.elapsed.
+    """
+    def __init__(self, step):
+        self.step = step
+        self.elapsed = None
+    
+    def __enter__(self):
+        timing_logger.info(json.dumps({"step": self.step, "event": "start"}))
+        self._start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self._start
+        timing_logger.info(json.dumps({"step": self.step, "event": "end",
+                                       "elapsed": self.elapsed}))
+        return False
+
+def run_eqw_fit(cfg, session=None):
     name = cfg["output_name"]
     NNpath = cfg["NN_file"]
     outdir = cfg["output_directory"]
     figdir = cfg["figure_directory"]
-    if not os.path.exists(outdir): os.makedirs(outdir)
-    if not os.path.exists(figdir): os.makedirs(figdir)
+    os.makedirs(outdir, exist_ok=True)
+    os.makedirs(figdir, exist_ok=True)
     print("Saving to output directory:",outdir)
     print("Saving figures to output directory:",figdir)
 
@@ -37,33 +64,37 @@ def run_eqw_fit(cfg):
         print("(Overwriting the file)")
 
     clear_all_existing_fits = ecfg["clear_all_existing_fits"]
+    # number of processes for the profile fits (-1 uses all cores)
+    n_jobs = ecfg.get("n_jobs", 1)
     
-    startall = time.time()
+    startall = time.perf_counter()
     
-    ## Load results of normalization
-    session = Session.load(smh_fname)
+    ## Load results of normalization (unless the session is handed over in memory)
+    # Existing models that will be cleared do not need to be reconstructed
+    if session is None:
+        with Timer("load"):
+            session = Session.load(smh_fname, skip_spectral_models=clear_all_existing_fits)
     all_exclude_regions, all_exclude_regions_2, norm_params = session.metadata["payne_masks"]
 
     if clear_all_existing_fits:
-        old_models = session.spectral_models
-        if len(old_models) > 0:
-            print(f"Deleting {len(old_models)} previously existing spectral models")
-        for model in old_models: del model
+        num_old_models = len(session.spectral_models)
+        if num_old_models > 0:
+            print(f"Deleting {num_old_models} previously existing spectral models")
         session.metadata["spectral_models"] = []
 
     ## Step 5: create linelist with masks
-    session.import_linelist_as_profile_models(linelist_fname)
-    for model in session.spectral_models:
-        w0 = model.wavelength
-        w1, w2 = w0 - model.metadata["window"], w0 + model.metadata["window"]
-        # keep if within w1 and w2 AND w0 not in region
-        this_exclude = [x for x in all_exclude_regions_2 if (x[1] > w1 and x[0] < w2) and ~(w0 > x[0] and w0 < x[1])]
-        model.metadata["mask"] = this_exclude
-        try:
-            model.fit()
-        except:
-            print(f"failed on species={model.species} wave={model.wavelength}")
-    print(f"Time to add masks to normalizations and import models: {time.time()-startall:.1f}")
+    with Timer("masks"):
+        session.import_linelist_as_profile_models(linelist_fname)
+        masks = _line_exclude_masks(all_exclude_regions_2,
+            [model.wavelength for model in session.spectral_models],
+            [model.metadata["window"] for model in session.spectral_models])
+        for model, mask in zip(session.spectral_models, masks):
+            model.metadata["mask"] = mask
+    with Timer("fit"):
+        # models are all new if the old fits were cleared, so nothing can be unchanged
+        fit_profile_models(session, session.spectral_models, n_jobs=n_jobs,
+                           skip_unchanged=not clear_all_existing_fits)
+    print(f"Time to add masks to normalizations and import models: {time.perf_counter()-startall:.1f}")
     
 #    ## Step 6: some quality control
 #    for model in session.spectral_models:
@@ -89,25 +120,223 @@ def run_eqw_fit(cfg):
     session.add_to_notes(notes)
 
     ## Save
-    session.save(smh_outfname, overwrite=True)
-    print(f"Total time to run all: {time.time()-startall:.1f}")
+    with Timer("save"):
+        session.save(smh_outfname, overwrite=True)
+    print(f"Total time to run all: {time.perf_counter()-startall:.1f}")
 
     ## Plot
     if ecfg["save_figure"]:
         figoutname = os.path.join(figdir, f"{name}_eqw.pdf")
-        start = time.time()
-        plot_eqw_grid(session, figoutname, name)
-        print(f"Time to save figure: {time.time()-start:.1f}")
+        with Timer("plot") as timer:
+            plot_eqw_grid(session, figoutname, name, n_jobs=n_jobs)
+        print(f"Time to save figure: {timer.elapsed:.1f}")
+    
+    return session
+        
+
+def _line_exclude_masks(exclude_regions, wavelengths, windows):
+    """
+    Return the exclude regions to mask for each line: the [start, end] regions
+    that overlap the line's fitting window (wavelength +/- window), apart from
+    those that contain the line center itself.
+    """
+    exclude_regions = np.asarray(exclude_regions, dtype=float).reshape(-1, 2)
+    # Sort by region start; the running maximum of the region ends is then
+    # also sorted, so each line only has to look at a small slice of regions
+    exclude_regions = exclude_regions[np.argsort(exclude_regions[:,0], kind="stable")]
+    exclude_max_ends = np.maximum.accumulate(exclude_regions[:,1])
+    masks = []
+    for w0, window in zip(wavelengths, windows):
+        w1, w2 = w0 - window, w0 + window
+        # keep if within w1 and w2 AND w0 not in region
+        i1 = exclude_max_ends.searchsorted(w1, side="right")
+        i2 = exclude_regions[:,0].searchsorted(w2, side="left")
+        candidates = exclude_regions[i1:i2]
+        keep = (candidates[:,1] > w1) & \
+               ~((w0 > candidates[:,0]) & (w0 < candidates[:,1]))
+        masks.append(candidates[keep].tolist())
+    return masks
+
+class _WorkerSession(object):
+    """
+    A minimal stand-in for a Session that can be sent to worker processes.
+    It holds only what ProfileFittingModel.fit and plot_model_fit need from
+    the parent session.
+    """
+
+    _setting_keys = ("covariance_draws", "error_percentiles", "show_full_profiles",
+                     ("spectral_model_quality_constraints", ))
+
+    def __init__(self, session, spectrum=None):
+        self.normalized_spectrum = session.normalized_spectrum if spectrum is None else spectrum
+        self._settings = dict([(key, session.setting(key)) for key in self._setting_keys])
+
+    def setting(self, key_tree, default_return_value=None):
+        value = self._settings.get(key_tree, None)
+        return default_return_value if value is None else value
+
+_worker_session = None
+
+def _init_worker(worker_session):
+    global _worker_session
+    _worker_session = worker_session
+
+def _fit_one(args):
+    """ Fit a single profile in a worker process, returning (fit_error, new metadata) """
+    transitions, metadata = args
+    model = ProfileFittingModel(_worker_session, transitions)
+    model.metadata.update(metadata)
+    if not model.fit():
+        return model.fit_error, None
+    return None, model.metadata
+
+_fingerprint_keys = ("profile", "central_weighting", "window", "continuum_order",
+                     "detection_sigma", "detection_pixels", "max_iterations",
+                     "wavelength_tolerance", "velocity_tolerance", "mask", "antimask_flag")
+
+def _fit_fingerprint(model, spectrum):
+    """
+    A hash of everything a profile fit depends on: the line wavelength,
+    the fitting metadata, and the spectrum pixels that are fit.
+    """
+    fingerprint = md5(repr([model.wavelength] + \
+        [model.metadata.get(key) for key in _fingerprint_keys]).encode("utf-8"))
+    mask = model.mask(spectrum)
+    for array in (spectrum.dispersion, spectrum.flux, spectrum.ivar):
+        fingerprint.update(np.ascontiguousarray(array[mask], dtype=float).tobytes())
+    return fingerprint.hexdigest()
+
+def fit_profile_models(session, models, n_jobs=1, chunksize=16, skip_unchanged=True):
+    """
+    Fit all models, in order of wavelength.
+    ProfileFittingModels whose fingerprint (wavelength, fitting metadata and
+    spectrum pixels) matches that of their last successful fit are skipped.
+    Pass skip_unchanged=False for freshly created models, which have no earlier
+    fit to compare against, to leave out the fingerprinting altogether.
+    If n_jobs != 1, the ProfileFittingModels are spread over a pool of n_jobs processes
+    (n_jobs=-1 uses all cores, -2 all but one, ...) and the fitted metadata copied
+    back to each model.
+    """
+    max_workers = num_workers(n_jobs)
+    # The profile fits do not need double precision flux and ivar (the wavelengths do).
+    # curve_fit upcasts the small fitting windows, so a float32 copy just halves the
+    # memory traffic; the session's own spectrum is left untouched.
+    spectrum = session.normalized_spectrum
+    fit_spectrum = Spectrum1D(spectrum.dispersion,
+        spectrum.flux.astype(np.float32), spectrum.ivar.astype(np.float32))
+    
+    def _fit_serial(models):
+        for model in models:
+            if isinstance(model, ProfileFittingModel):
+                if not model.fit(fit_spectrum):
+                    print(f"failed on species={model.species} wave={model.wavelength}: {model.fit_error}")
+                continue
+            try:
+                model.fit()
+            except Exception as e:
+                print(f"failed on species={model.species} wave={model.wavelength}: {e}")
+    
+    fingerprints = {}
+    models_to_fit = []
+    for model in models:
+        if skip_unchanged and isinstance(model, ProfileFittingModel):
+            fingerprint = _fit_fingerprint(model, fit_spectrum)
+            if "fitted_result" in model.metadata and \
+               model.metadata.get("fit_fingerprint") == fingerprint:
+                continue
+            fingerprints[model] = fingerprint
+        models_to_fit.append(model)
+    num_skipped = len(models) - len(models_to_fit)
+    if num_skipped > 0:
+        print(f"Skipping {num_skipped} unchanged fits")
+    # Fit in wavelength order so consecutive fits touch adjacent parts of the
+    # normalized spectrum; the caller's list (and the session order) is unchanged
+    order = np.argsort([model.wavelength for model in models_to_fit], kind="stable")
+    models = [models_to_fit[i] for i in order]
+    
+    if max_workers == 1:
+        _fit_serial(models)
+    else:
+        # Only profile models are simple enough to send to other processes
+        _fit_serial([m for m in models if not isinstance(m, ProfileFittingModel)])
+        models = [m for m in models if isinstance(m, ProfileFittingModel)]
         
+        from concurrent.futures import ProcessPoolExecutor
+        inputs = [(model.transitions, model.metadata) for model in models]
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(_WorkerSession(session, fit_spectrum),)) as executor:
+            results = list(executor.map(_fit_one, inputs, chunksize=chunksize))
+        for model, (fit_error, metadata) in zip(models, results):
+            if metadata is None:
+                print(f"failed on species={model.species} wave={model.wavelength}: {fit_error}")
+                model.metadata["is_acceptable"] = False
+                model.metadata.pop("fitted_result", None)
+                continue
+            model.metadata.clear()
+            model.metadata.update(metadata)
+    
+    for model, fingerprint in fingerprints.items():
+        if "fitted_result" in model.metadata:
+            model.metadata["fit_fingerprint"] = fingerprint
+        else:
+            model.metadata.pop("fit_fingerprint", None)
+
+def _plot_eqw_panels(axes, session, models, offset=0):
+    # Look up each element name once, there are only a few species
+    elements = dict([(species, utils.species_to_element(species).replace(' ',''))
+                     for species in set([model.species[0] for model in models])])
+    labels = [f"{elements[model.species[0]]}{model.wavelength:.0f}" for model in models]
+    linewaves = [model.transitions[0]["wavelength"] for model in models]
+    for j, (model, label, linewave) in enumerate(zip(models, labels, linewaves)):
+        ax = axes.flat[j+offset]
+        ax.set_rasterized(True)
+        try:
+            plot_model_fit(ax, session, model, label=label,
+                           linewave=linewave, inset_dwl=None, rasterized=True)
+        except Exception as e:
+            print("Error:",j+offset,model.species,model.wavelength)
+            print(e)
+            print("Skipping...")
+
+def _finish_eqw_figure(fig, name):
+    fig.subplots_adjust(top=.97, wspace=0.12, hspace=.12,
+                        bottom=0.02, left=0.03, right=0.99)
+    fig.suptitle(name, fontsize=30, weight='bold', fontfamily='monospace',color='k')
+
+def _render_eqw_page(args):
+    """ Plot one page of the eqw grid in a worker process and save it to fname """
+    import matplotlib.pyplot as plt
+    model_inputs, name, Nrowmax, Ncol, width, height, dpi, fname = args
+    models = []
+    for transitions, metadata in model_inputs:
+        model = ProfileFittingModel(_worker_session, transitions)
+        model.metadata.update(metadata)
+        models.append(model)
+    fig, axes = plt.subplots(Nrowmax, Ncol, figsize=(width*Ncol, height*Nrowmax))
+    _plot_eqw_panels(axes, _worker_session, models)
+    _finish_eqw_figure(fig, name)
+    fig.savefig(fname, dpi=dpi)
+    plt.close(fig)
+    return fname
 
 def plot_eqw_grid(session, outfname, name,
-                  Nrowmax=5, Ncol=4, width=6, height=4, dpi=150):
+                  Nrowmax=5, Ncol=4, width=6, height=4, dpi=100, n_jobs=1):
+    """
+    Plot all eqw fits to a multi-page pdf, starting with the summary panels.
+    The line panels are rasterized at dpi, the summary panels stay vector.
+    If n_jobs != 1 and pypdf is installed, the pages after the first are
+    rendered by a pool of n_jobs processes (-1 uses all cores, -2 all but one,
+    ...) and merged.
+    """
+    max_workers = num_workers(n_jobs)
     import matplotlib.pyplot as plt
     from matplotlib.backends.backend_pdf import PdfPages
     eqw_models = [m for m in session.spectral_models if isinstance(m, ProfileFittingModel)]
     N_extra = 4
-    N = len(eqw_models) + N_extra
     Nmax = Nrowmax * Ncol
+    # The first page starts with the summary panels
+    pages = [eqw_models[:Nmax-N_extra]] + \
+        [eqw_models[i:i+Nmax] for i in range(Nmax-N_extra, len(eqw_models), Nmax)]
     
     ltab = get_line_table(session, True)
     
@@ -116,32 +345,42 @@ def plot_eqw_grid(session, outfname, name,
     plot_summary_2(axes.flat[1], session, ltab)
     plot_fe_trends(axes.flat[2], session, "expot", ltab)
     plot_fe_trends(axes.flat[3], session, "REW", ltab)
-    first_figure = 1
-    with PdfPages(outfname) as pdf:
-        def finish_fig(fig):
-            fig.subplots_adjust(top=.97, wspace=0.12, hspace=.12,
-                                bottom=0.02, left=0.03, right=0.99)
-            fig.suptitle(name, fontsize=30, weight='bold', fontfamily='monospace',color='k')
-            pdf.savefig(fig)
+    _plot_eqw_panels(axes, session, pages[0], offset=N_extra)
+    _finish_eqw_figure(fig, name)
+    
+    if max_workers != 1 and len(pages) > 1:
+        try:
+            from pypdf import PdfWriter
+        except ImportError:
+            print("pypdf is not installed, plotting eqw pages serially")
+            max_workers = 1
+    
+    if max_workers == 1 or len(pages) == 1:
+        with PdfPages(outfname) as pdf:
+            pdf.savefig(fig, dpi=dpi)
             plt.close(fig)
-            
-            fig, axes = plt.subplots(Nrowmax, Ncol, figsize=(width*Ncol, height*Nrowmax))
-            return fig, axes
-        for i, model in enumerate(eqw_models):
-            iall = i+N_extra
-            if iall % Nmax == 0 and iall > 0:
-                fig, axes = finish_fig(fig)
-                first_figure = 0
-            j = iall % Nmax
-            ax = axes.flat[j]
-            linewave = model.transitions[0]["wavelength"]
-            label = f"{utils.species_to_element(model.species[0]).replace(' ','')}{model.wavelength:.0f}"
-            try:
-                plot_model_fit(ax, session, model, label=label,
-                               linewave=linewave, inset_dwl=None)
-            except Exception as e:
-                print("Error:",i,model.species,model.wavelength)
-                print(e)
-                print("Skipping...")
-        fig, axes = finish_fig(fig)
-        plt.close(fig)
+            for models in pages[1:]:
+                fig, axes = plt.subplots(Nrowmax, Ncol, figsize=(width*Ncol, height*Nrowmax))
+                _plot_eqw_panels(axes, session, models)
+                _finish_eqw_figure(fig, name)
+                pdf.savefig(fig, dpi=dpi)
+                plt.close(fig)
+        return
+    
+    from concurrent.futures import ProcessPoolExecutor
+    twd = utils.mkdtemp()
+    fnames = [os.path.join(twd, f"page{ipage:04d}.pdf") for ipage in range(len(pages))]
+    fig.savefig(fnames[0], dpi=dpi)
+    plt.close(fig)
+    inputs = [([(model.transitions, model.metadata) for model in models],
+               name, Nrowmax, Ncol, width, height, dpi, fname)
+              for models, fname in zip(pages[1:], fnames[1:])]
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(_WorkerSession(session),)) as executor:
+        list(executor.map(_render_eqw_page, inputs))
+    writer = PdfWriter()
+    for fname in fnames:
+        writer.append(fname)
+    with open(outfname, "wb") as fp:
+        writer.write(fp)
+    rmtree(twd)
@@ -10,13 +10,13 @@ from LESSPayne.smh.spectral_models import ProfileFittingModel, SpectralSynthesis
 from LESSPayne.smh.photospheres.abundances import asplund_2009 as solar_composition
 from LESSPayne.PayneEchelle.spectral_model import DefaultPayneModel
 
-def run_errors(cfg):
+def run_errors(cfg, session=None):
     name = cfg["output_name"]
     NNpath = cfg["NN_file"]
     outdir = cfg["output_directory"]
     figdir = cfg["figure_directory"]
-    if not os.path.exists(outdir): os.makedirs(outdir)
-    if not os.path.exists(figdir): os.makedirs(figdir)
+    os.makedirs(outdir, exist_ok=True)
+    os.makedirs(figdir, exist_ok=True)
     print("Saving to output directory:",outdir)
     print("Saving figures to output directory:",figdir)
     
@@ -35,7 +35,8 @@ def run_errors(cfg):
 
     startall = time.time()
     
-    session = Session.load(smh_fname)
+    if session is None:
+        session = Session.load(smh_fname)
     
     ## Set default errors or override
     if errcfg["e_Teff"] is not None:
@@ -81,3 +82,5 @@ def run_errors(cfg):
     session.save(smh_outfname, overwrite=True)
     print(f"Total time run_errors: {time.time()-startall:.1f}")
     
+    return session
+    
@@ -1,11 +1,11 @@
 import numpy as np
 import sys, os, time
 import yaml
-from copy import deepcopy
 from scipy.ndimage import gaussian_filter1d
 
 from LESSPayne.smh import Session
 from LESSPayne.specutils import Spectrum1D 
+from LESSPayne.specutils.spectrum import regions_to_mask
 from LESSPayne.smh.spectral_models import ProfileFittingModel, SpectralSynthesisModel
 from LESSPayne.smh.photospheres.abundances import asplund_2009 as solar_composition
 from LESSPayne.PayneEchelle.spectral_model import DefaultPayneModel
@@ -107,9 +107,7 @@ def get_norm_params(popt, model):
     return params
 
 def merge_exclude_regions(super_wave, exclude_regions, Nwave):
-    super_mask = np.zeros_like(super_wave, dtype=bool)
-    for excludes in exclude_regions:
-        super_mask[(super_wave > excludes[0]) & (super_wave < excludes[1])] = True
+    super_mask = regions_to_mask(super_wave, exclude_regions)
     maskdiff = np.diff(np.concatenate([[False], super_mask]).astype(int))
     starts = np.where(maskdiff == 1)[0]
     stops = np.where(maskdiff == -1)[0]
@@ -203,8 +201,8 @@ def run_normalization(cfg):
     NNpath = cfg["NN_file"]
     outdir = cfg["output_directory"]
     figdir = cfg["figure_directory"]
-    if not os.path.exists(outdir): os.makedirs(outdir)
-    if not os.path.exists(figdir): os.makedirs(figdir)
+    os.makedirs(outdir, exist_ok=True)
+    os.makedirs(figdir, exist_ok=True)
     print("Saving to output directory:",outdir)
     print("Saving figures to output directory:",figdir)
     
@@ -350,7 +348,7 @@ def run_normalization(cfg):
     all_kwds = [{} for i in range(num_order)]
 
     for i, spec in enumerate(session.input_spectra):
-        kwds = deepcopy(default_kwds)
+        kwds = default_kwds.copy()
         
         # Apply RV correction before normalization, mimicking SMHR normalization gui
         spec = spec.copy()
@@ -373,9 +371,7 @@ def run_normalization(cfg):
         # Ensure each knot has a significant number of unmasked pixels
         wave = spec.dispersion
         # Recompute the mask
-        mask = np.zeros(wave.size, dtype=bool)
-        for w1, w2 in all_exclude:
-            mask[(w1 <= wave) & (wave <= w2)] = True
+        mask = regions_to_mask(wave, all_exclude, inclusive=True)
         print(f"Wave={np.median(wave):.0f}")
         for it in range(10):
             try:
@@ -383,12 +379,12 @@ def run_normalization(cfg):
                 # assign pixels to knots and count the unmasked points
                 best_knot = np.argmin(np.abs(wave[:,np.newaxis] - knots[np.newaxis,:]), axis=1)
                 assert best_knot.size==wave.size, (best_knot.size, wave.size)
-                frac_per_knot = np.inf
-                # this finds the worst knot
-                for j, knot in enumerate(knots):
-                    ii1 = j==best_knot
-                    ii2 = ~mask
-                    frac_per_knot = min(frac_per_knot, np.sum(ii1&ii2)/np.sum(ii1))
+                # this finds the worst knot (knots without pixels are ignored)
+                num_per_knot = np.bincount(best_knot, minlength=len(knots))
+                num_good_per_knot = np.bincount(best_knot, weights=~mask, minlength=len(knots))
+                has_pixels = num_per_knot > 0
+                frac_per_knot = np.min(num_good_per_knot[has_pixels]/num_per_knot[has_pixels],
+                                       initial=np.inf)
                 if frac_per_knot > min_frac_per_knot: break
                 knot_spacing += 2
                 print(f"  {frac_per_knot:.2f} < {min_frac_per_knot} increasing knot_spacing to {knot_spacing}")
@@ -423,3 +419,5 @@ def run_normalization(cfg):
         start = time.time()
         plot_norm_one_session(session, figoutname)
         print(f"Time to save figure: {time.time()-start:.1f}")
+    
+    return session
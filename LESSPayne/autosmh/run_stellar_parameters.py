@@ -1,25 +1,28 @@
 import numpy as np
-import sys, os, time
-import yaml
-from copy import deepcopy
-from scipy.ndimage import gaussian_filter1d
+import os, time
 
 from LESSPayne.smh import Session
-from LESSPayne.specutils import Spectrum1D 
-from LESSPayne.smh.spectral_models import ProfileFittingModel, SpectralSynthesisModel
-from LESSPayne.smh.photospheres.abundances import asplund_2009 as solar_composition
-from LESSPayne.PayneEchelle.spectral_model import DefaultPayneModel, YYLiPayneModel
+from LESSPayne.PayneEchelle.spectral_model import DefaultPayneModel
+from LESSPayne.utils import num_workers
 
 from .run_eqw_fit import plot_eqw_grid
 
-def run_stellar_parameters(cfg):
+## Corrections from empirical fit to RPA duplicates: rows are (slope, intercept)
+## of dTeff, dlogg, d[M/H] as linear functions of Teff, logg, [M/H]
+_RPA_CALIBRATION = np.array([[-.0732691466, 247.57],
+                             [8.11486e-5, -0.28526],
+                             [-0.06242672, -0.3167661]])
+## vt(logg) polynomial from RPA duplicates, highest power first
+_RPA_VT_POLY = np.array([0.060, -0.569, 2.585])
+
+def run_stellar_parameters(cfg, session=None):
     name = cfg["output_name"]
     NNpath = cfg["NN_file"]
     NNtype = cfg["NN_type"]
     outdir = cfg["output_directory"]
     figdir = cfg["figure_directory"]
-    if not os.path.exists(outdir): os.makedirs(outdir)
-    if not os.path.exists(figdir): os.makedirs(figdir)
+    os.makedirs(outdir, exist_ok=True)
+    os.makedirs(figdir, exist_ok=True)
     print("Saving to output directory:",outdir)
     print("Saving figures to output directory:",figdir)
     
@@ -43,23 +46,21 @@ def run_stellar_parameters(cfg):
 
     startall = time.time()
     
-    ## Load results of normalization
-    session = Session.load(smh_fname)
+    ## Load results of normalization (unless the session is handed over in memory)
+    if session is None:
+        session = Session.load(smh_fname)
     
     ## Step 7: initialize stellar parameters
     if spcfg["method"] == "rpa_calibration":
         if NNtype == "default":
             model = DefaultPayneModel.load(NNpath, 1)
             with np.load(popt_fname) as tmp:
-                popt_best = tmp["popt_best"].copy()
-                popt_print = tmp["popt_print"].copy()
+                popt_print = tmp["popt_print"]
             Teff, logg, MH, aFe = round(popt_print[0]), round(popt_print[1],2), round(popt_print[2],2), round(popt_print[3],2)
             outstr1 = f"run_stellar_parameters:\n  PayneEchelle {NNpath}: T/g/v/M/a = {Teff}/{logg}/1.00/{MH}/{aFe}"
             
             ## Corrections from empirical fit to RPA duplicates
-            dT = -.0732691466 * Teff + 247.57
-            dg = 8.11486e-5 * logg - 0.28526
-            dM = -0.06242672*MH - 0.3167661
+            dT, dg, dM = _RPA_CALIBRATION[:,0] * np.array([Teff, logg, MH]) + _RPA_CALIBRATION[:,1]
             Teff, logg, MH = int(Teff - dT), round(logg - dg,2), round(MH - dM, 2)
             
             ## TODO
@@ -69,15 +70,15 @@ def run_stellar_parameters(cfg):
             
             ## TODO offer different vt methods
             #vt = round(2.13 - 0.23 * logg,2) # kirby09
-            vt = round(0.060 * logg**2 - 0.569*logg + 2.585, 2) # RPA duplicates
+            a2, a1, a0 = _RPA_VT_POLY
+            vt = round(a2 * logg**2 + a1*logg + a0, 2) # RPA duplicates
     
             outstr2 = f"  Calibrated = {Teff}/{logg}/{vt}/{MH}/{aFe}"
             session.add_to_notes(outstr1+"\n"+outstr2)
         elif NNtype == "yyli":
             model = DefaultPayneModel.load(NNpath, 1)
             with np.load(popt_fname) as tmp:
-                popt_best = tmp["popt_best"].copy()
-                popt_print = tmp["popt_print"].copy()
+                popt_print = tmp["popt_print"]
             Teff, logg, vt, MH = round(popt_print[0]), round(popt_print[1],2), round(popt_print[2],2), round(popt_print[3],2)
             CFe, MgFe, CaFe, TiFe = round(popt_print[4]), round(popt_print[5],2), round(popt_print[6],2), round(popt_print[7],2)
             aFe = round((MgFe+CaFe+TiFe)/3., 2)
@@ -129,5 +130,43 @@ def run_stellar_parameters(cfg):
         start = time.time()
         plot_eqw_grid(session, figoutname, name)
         print(f"Time to save eqw figure: {time.time()-start:.1f}")
+    
+    return session
         
     
+
+def _run_stellar_parameters_job(args):
+    """
+    Worker for run_stellar_parameters_batch. It returns only the output path:
+    sending the Session back would pickle it through the pipe for nothing.
+    """
+    cfg, outfname = args
+    run_stellar_parameters(cfg)
+    return outfname
+
+def run_stellar_parameters_batch(cfg_list, n_jobs=-1):
+    """
+    Run run_stellar_parameters on many stars, one star per worker process.
+    n_jobs=-1 uses all cores (-2 all but one, ...), n_jobs=1 runs serially.
+    Every cfg must write to its own smh file; MOOG scratch files already go to
+    each session's own temporary directory, so workers do not collide there.
+    Returns the list of smh files written.
+    """
+    outfnames = []
+    for cfg in cfg_list:
+        smh_fname = os.path.join(cfg["output_directory"], cfg["smh_fname"])
+        suffix = cfg["run_stellar_parameters"].get("output_suffix")
+        if suffix is not None:
+            smh_fname = smh_fname.replace(".smh", suffix+".smh")
+        outfnames.append(os.path.abspath(smh_fname))
+    if len(set(outfnames)) != len(outfnames):
+        raise ValueError("run_stellar_parameters_batch: cfgs must write to distinct smh files")
+    
+    max_workers = num_workers(n_jobs)
+    if max_workers == 1:
+        return list(map(_run_stellar_parameters_job, zip(cfg_list, outfnames)))
+    
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_run_stellar_parameters_job,
+                                 zip(cfg_list, outfnames), chunksize=1))
@@ -112,13 +112,13 @@ def update_abundance_table_2(session, model):
             fitted_result[0][key] = abund
             fitted_result[2]["abundances"][i] = abund
 
-def run_synth_fit(cfg):
+def run_synth_fit(cfg, session=None):
     name = cfg["output_name"]
     NNpath = cfg["NN_file"]
     outdir = cfg["output_directory"]
     figdir = cfg["figure_directory"]
-    if not os.path.exists(outdir): os.makedirs(outdir)
-    if not os.path.exists(figdir): os.makedirs(figdir)
+    os.makedirs(outdir, exist_ok=True)
+    os.makedirs(figdir, exist_ok=True)
     print("Saving to output directory:",outdir)
     print("Saving figures to output directory:",figdir)
 
@@ -150,8 +150,9 @@ def run_synth_fit(cfg):
     
     startall = time.time()
     
-    ## Load results of normalization
-    session = Session.load(smh_fname)
+    ## Load results of normalization (unless the session is handed over in memory)
+    if session is None:
+        session = Session.load(smh_fname)
     
     if scfg["clear_all_existing_syntheses"]:
         synthesis_models = [x for x in session.spectral_models if isinstance(x, SpectralSynthesisModel)]
@@ -251,6 +252,8 @@ def run_synth_fit(cfg):
         start = time.time()
         plot_synth_grid(session, figoutname, name)
         print(f"Time to save figure: {time.time()-start:.1f}")
+    
+    return session
 
 def plot_synth_grid(session, outfname, name,
                     Ncol=3, width=10, height=4, dpi=150,
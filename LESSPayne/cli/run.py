@@ -11,6 +11,71 @@ from LESSPayne.autosmh.run_errors import run_errors
 #from LESSPayne.autosmh.run_summary import run_summary
 
 
+def _next_session(session, cfg, key):
+    """ Keep the session for the next phase only if it went to the smh file that phase reads """
+    if cfg[key].get("output_suffix") is None:
+        return session
+    return None
+
+def run_pipeline(cfg, options):
+    """
+    Run the phases selected in options in order.
+    After a phase saves the smh file, the next phase is handed the same Session
+    in memory instead of loading that file back from disk. A phase with an
+    output_suffix wrote to a different file, so the next phase loads as usual.
+    """
+    session = None
+    
+    ## PayneEchelle
+    # Input: config file, spectrum files to analyze
+    # Output: payneechelle fit npz file
+    # Optional output: figure for each order showing fit
+    if options.run_payneechelle:
+        run_payne_echelle(cfg)
+    
+    ## Normalization
+    # Input: payneechelle fit, spectrum files to analyze
+    # Output: SMHR file with normalization done, mask file
+    # Optional output: order normalization stamps
+    if options.run_normalization:
+        session = run_normalization(cfg)
+    
+    ## EQW
+    # Input: SMHR file with normalization done, mask file
+    # Output: SMHR file with EQWs fit
+    # Optional output: EQW stamp plot
+    # Optional output: line abundance table
+    if options.run_equivalent_width:
+        session = run_eqw_fit(cfg, session=session)
+        session = _next_session(session, cfg, "run_eqw_fit")
+    
+    ## StellarParams
+    # Input: SMHR file
+    # Optional input: Payneechelle file
+    # Optional input: manual stellar parameters
+    # Output: SMHR file with stellar parameters added
+    if options.run_stellar_parameters:
+        session = run_stellar_parameters(cfg, session=session)
+        session = _next_session(session, cfg, "run_stellar_parameters")
+    
+    ## Synth
+    # Input: SMHR file with normalization and eqw done
+    # Output: SMHR file with syntheses fit
+    # Optional output: synth stamp plot
+    # Optional output: line abundance table
+    if options.run_synthesis:
+        session = run_synth_fit(cfg, session=session)
+        session = _next_session(session, cfg, "run_synth_fit")
+    
+    ## Errors
+    # Input: SMHR file with all abundances you want done
+    # Optional input: SP covariance matrix
+    # Output: SMHR file with errors propagated
+    # Optional output: 
+    if options.run_errors:
+        run_errors(cfg, session=session)
+
+
 if __name__=="__main__":
     start = time.time()
     
@@ -59,51 +124,7 @@ if __name__=="__main__":
     print("Saving figures to output directory:",figdir)
     
     
-    ## PayneEchelle
-    # Input: config file, spectrum files to analyze
-    # Output: payneechelle fit npz file
-    # Optional output: figure for each order showing fit
-    if options.run_payneechelle:
-        run_payne_echelle(cfg)
-    
-    ## Normalization
-    # Input: payneechelle fit, spectrum files to analyze
-    # Output: SMHR file with normalization done, mask file
-    # Optional output: order normalization stamps
-    if options.run_normalization:
-        run_normalization(cfg)
-    
-    ## EQW
-    # Input: SMHR file with normalization done, mask file
-    # Output: SMHR file with EQWs fit
-    # Optional output: EQW stamp plot
-    # Optional output: line abundance table
-    if options.run_equivalent_width:
-        run_eqw_fit(cfg)
-    
-    ## StellarParams
-    # Input: SMHR file
-    # Optional input: Payneechelle file
-    # Optional input: manual stellar parameters
-    # Output: SMHR file with stellar parameters added
-    if options.run_stellar_parameters:
-        run_stellar_parameters(cfg)
-    
-    ## Synth
-    # Input: SMHR file with normalization and eqw done
-    # Output: SMHR file with syntheses fit
-    # Optional output: synth stamp plot
-    # Optional output: line abundance table
-    if options.run_synthesis:
-        run_synth_fit(cfg)
-    
-    ## Errors
-    # Input: SMHR file with all abundances you want done
-    # Optional input: SP covariance matrix
-    # Output: SMHR file with errors propagated
-    # Optional output: 
-    if options.run_errors:
-        run_errors(cfg)
+    run_pipeline(cfg, options)
 
     print(f"Time to run LESSPayne: {time.time()-start:.1f}")
     
@@ -20,7 +20,6 @@ from six import string_types, iteritems
 from six.moves import cPickle as pickle
 from shutil import copyfile, rmtree
 #from tempfile import mkdtemp
-from copy import deepcopy
 import warnings
 
 import astropy.table
@@ -69,17 +68,13 @@ class Session(BaseSession):
         self.twd = twd
         logger.info("Working directory: {}".format(twd))
 
-        # Load the spectra and flatten all orders into a single list.
-        input_spectra = []
-        for path in spectrum_paths:
-            s = specutils.Spectrum1D.read(path)
-            if isinstance(s, list):
-                input_spectra.extend(s)
-            else:
-                input_spectra.append(s)
-        
-        # Sort orders from blue to red.
-        input_spectra.sort(key=lambda order: order.dispersion.mean())
+        # We only store this so that we can retain the original file format for
+        # when we save the session.
+        self._input_spectra_paths = spectrum_paths
+
+        # The input spectra are read on first access. A loaded session
+        # often only needs the normalized spectrum, so it skips reading them.
+        self._input_spectra = None
 
         # TODO: Store the path names internally for provenance?
 
@@ -93,20 +88,16 @@ class Session(BaseSession):
         common_metadata_keys = ["RA", "DEC", "OBJECT"] \
             + kwargs.pop("common_metadata_keys", [])
 
-        for key in common_metadata_keys:
-            for order in input_spectra:
-                if key in order.metadata:
-                    self.metadata[key] = order.metadata[key]
-                    break
-
-        self.input_spectra = input_spectra
-
-        # We only store this so that we can retain the original file format for
-        # when we save the session.
-        self._input_spectra_paths = spectrum_paths
+        # (A loaded session replaces all of this metadata with the saved copy)
+        if not from_load:
+            for key in common_metadata_keys:
+                for order in self.input_spectra:
+                    if key in order.metadata:
+                        self.metadata[key] = order.metadata[key]
+                        break
         
         # Initialize metadata dictionary.
-        N = len(self.input_spectra)
+        N = 0 if from_load else len(self.input_spectra)
         self.metadata.update({
             "rv": {},
             "normalization": {
@@ -163,6 +154,33 @@ class Session(BaseSession):
         return None
 
 
+    @property
+    def input_spectra(self):
+        """
+        The input spectrum orders, sorted from blue to red. They are read from
+        the input spectrum paths on first access.
+        """
+        if self._input_spectra is None:
+            # Load the spectra and flatten all orders into a single list.
+            input_spectra = []
+            for path in self._input_spectra_paths:
+                s = specutils.Spectrum1D.read(path)
+                if isinstance(s, list):
+                    input_spectra.extend(s)
+                else:
+                    input_spectra.append(s)
+            
+            # Sort orders from blue to red.
+            input_spectra.sort(key=lambda order: order.dispersion.mean())
+            self._input_spectra = input_spectra
+        return self._input_spectra
+
+
+    @input_spectra.setter
+    def input_spectra(self, input_spectra):
+        self._input_spectra = input_spectra
+
+
     def save(self, session_path, overwrite=False, **kwargs):
         """
         Save the Session to disk.
@@ -196,7 +214,9 @@ class Session(BaseSession):
             raise IOError("path '{}' already exists".format(session_path))
 
         metadata = self.metadata.copy()
-        protocol = kwargs.pop("protocol", 2)
+        # With protocol 5 numpy arrays are written straight from their buffers
+        # instead of via an intermediate bytes copy; load detects the protocol.
+        protocol = kwargs.pop("protocol", pickle.HIGHEST_PROTOCOL)
 
         # Create a temporary working directory and copy files over.
         twd = mkdtemp(**kwargs)
@@ -249,11 +269,15 @@ class Session(BaseSession):
         # normalized spectrum.
         #twd_path = safe_path(os.path.join(twd, "normalized_spectrum.fits"),
         #    twd, metadata)
-        ## HACK while fits is broken, it should be called .txt
-        twd_path = safe_path(os.path.join(twd, "normalized_spectrum.txt"),
+        ## Stored as a compressed numpy archive, which is lossless and much
+        ## faster to write and read than the old .txt (still readable on load)
+        twd_path = safe_path(os.path.join(twd, "normalized_spectrum.npz"),
             twd, metadata)
         try:
-            self.normalized_spectrum.write(twd_path)
+            np.savez_compressed(twd_path,
+                dispersion=self.normalized_spectrum.dispersion,
+                flux=self.normalized_spectrum.flux,
+                ivar=self.normalized_spectrum.ivar)
 
         except AttributeError:
             None
@@ -442,8 +466,14 @@ class Session(BaseSession):
         normalized_spectrum \
             = metadata["reconstruct_paths"].get("normalized_spectrum", None)
         if normalized_spectrum is not None:
-            session.normalized_spectrum = specutils.Spectrum1D.read(
-                os.path.join(twd, normalized_spectrum))
+            normalized_spectrum = os.path.join(twd, normalized_spectrum)
+            if normalized_spectrum.endswith(".npz"):
+                with np.load(normalized_spectrum) as data:
+                    session.normalized_spectrum = specutils.Spectrum1D(
+                        data["dispersion"], data["flux"], data["ivar"])
+            else:
+                session.normalized_spectrum = specutils.Spectrum1D.read(
+                    normalized_spectrum)
 
         # Remove any reconstruction paths.
         metadata.pop("reconstruct_paths")
@@ -999,7 +1029,7 @@ class Session(BaseSession):
         from scipy.optimize import fmin
         from scipy.stats import linregress
         start = time.time()
-        saved_stellar_params = deepcopy(self.metadata["stellar_parameters"])
+        saved_stellar_params = self.metadata["stellar_parameters"].copy()
         
         # Use abundance errors in fit? Should just not use this by default for now
         if self.setting(("stellar_parameter_inference", 
@@ -1045,13 +1075,13 @@ class Session(BaseSession):
         # (Might be unnecessary)
         try:
             # MH: stdev of all Fe lines (including Fe I and II)
-            self.metadata["stellar_parameters"] = deepcopy(saved_stellar_params)
+            self.metadata["stellar_parameters"] = saved_stellar_params.copy()
             abundances = self.rt.abundance_cog(self.stellar_photosphere, transitions, twd=self.twd)
             mh_error = np.nanstd(abundances)
             
             # Teff
             try:
-                self.metadata["stellar_parameters"] = deepcopy(saved_stellar_params)
+                self.metadata["stellar_parameters"] = saved_stellar_params.copy()
                 m, b, median, sigma, N = initial_slopes[expot_balance_species].get("expot", (np.nan,np.nan,np.nan,np.nan,0))
                 logger.info("Finding error in Teff slope: {:.3f} +/- {:.3f}".format(m, sigma[1]))
                 Teff = saved_stellar_params["effective_temperature"]
@@ -1068,7 +1098,7 @@ class Session(BaseSession):
                 minfn = lambda teff: (m_target - _calculate_teff_slope(teff[0]))**2
                 Teff_positive_slope = fmin(minfn, [Teff], xtol=tolerances[0], ftol=0.00001)[0]
                 Teff_error = int(round(np.abs(Teff_positive_slope - Teff)))
-                self.metadata["stellar_parameters"] = deepcopy(saved_stellar_params)
+                self.metadata["stellar_parameters"] = saved_stellar_params.copy()
                 logger.info("Teff: {} + {}".format(Teff, Teff_error))
             except:
                 logger.warn("Error calculating uncertainties in Teff")
@@ -1076,7 +1106,7 @@ class Session(BaseSession):
 
             # logg
             try:
-                self.metadata["stellar_parameters"] = deepcopy(saved_stellar_params)
+                self.metadata["stellar_parameters"] = saved_stellar_params.copy()
                 def _get_fe_values(abundances, transitions):
                     ii1 = transitions["species"] == ionization_balance_species_1
                     ii2 = transitions["species"] == ionization_balance_species_2
@@ -1104,7 +1134,7 @@ class Session(BaseSession):
                 minfn = lambda logg: (dFe_target - _calculate_logg_dFe(logg[0]))**2
                 logg_positive_error = fmin(minfn, [logg], xtol=tolerances[1], ftol=0.00001)[0]
                 logg_error = np.abs(logg_positive_error - logg)
-                self.metadata["stellar_parameters"] = deepcopy(saved_stellar_params)
+                self.metadata["stellar_parameters"] = saved_stellar_params.copy()
                 logger.info("logg: {:.2f} + {:.2f}".format(logg, logg_error))
             except:
                 logger.warn("Error calculating uncertainties in logg")
@@ -1112,7 +1142,7 @@ class Session(BaseSession):
 
             # vt
             try:
-                self.metadata["stellar_parameters"] = deepcopy(saved_stellar_params)
+                self.metadata["stellar_parameters"] = saved_stellar_params.copy()
                 m, b, median, sigma, N = initial_slopes[rew_balance_species].get("reduced_equivalent_width", (np.nan,np.nan,np.nan,np.nan,0))
                 logger.info("Finding error in vt slope: {:.3f} +/- {:.3f}".format(m, sigma[1]))
                 vt = saved_stellar_params["microturbulence"]
@@ -1129,17 +1159,17 @@ class Session(BaseSession):
                 minfn = lambda vt: (m_target - _calculate_vt_slope(vt[0]))**2
                 vt_positive_slope = fmin(minfn, [vt], xtol=tolerances[2], ftol=0.00001)[0]
                 vt_error = round(np.abs(vt_positive_slope - vt),2)
-                self.metadata["stellar_parameters"] = deepcopy(saved_stellar_params)
+                self.metadata["stellar_parameters"] = saved_stellar_params.copy()
                 logger.info("vt: {:.2f} + {:.2f}".format(vt, vt_error))
             except:
                 logger.warn("Error calculating uncertainties in vt")
                 raise
 
         except Exception as e:
-            self.metadata["stellar_parameters"] = deepcopy(saved_stellar_params)
+            self.metadata["stellar_parameters"] = saved_stellar_params.copy()
             raise
         else:
-            self.metadata["stellar_parameters"] = deepcopy(saved_stellar_params)
+            self.metadata["stellar_parameters"] = saved_stellar_params.copy()
             self.set_stellar_parameters_errors("stat", Teff_error, logg_error, vt_error, mh_error)
             logger.info("Uncertainties: dTeff={:.0f} dlogg={:.2f} dvt={:.2f} dmh={:.2f}, took {:.1f}s".format(
                     Teff_error, logg_error, vt_error, mh_error, time.time()-start))
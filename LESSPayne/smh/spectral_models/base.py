@@ -372,13 +372,18 @@ class BaseSpectralModel(object):
 
         :param spectrum:
             A spectrum to generate a mask for.
+
+        The part of the mask inside the fitting window is cached on the model,
+        keyed by the window pixels it was built from and the masked ranges, so
+        repeated calls during a fit only rebuild the full-length array.
         """
 
+        dispersion = spectrum.dispersion
         if self.metadata["antimask_flag"]:
-            antimask = np.ones_like(spectrum.dispersion,dtype=bool)
+            antimask = np.ones_like(dispersion,dtype=bool)
             for start, end in self.metadata["mask"]:
-                antimask *= ~((spectrum.dispersion >= start) \
-                            * (spectrum.dispersion <= end))
+                antimask *= ~((dispersion >= start) \
+                            * (dispersion <= end))
             return ~antimask
 
         window = abs(self.metadata["window"])
@@ -390,14 +395,27 @@ class BaseSpectralModel(object):
             # Single row.
             lower_wavelength, upper_wavelength = (wavelengths, wavelengths)
 
-        mask = (spectrum.dispersion >= lower_wavelength - window) \
-             * (spectrum.dispersion <= upper_wavelength + window)
+        # The dispersion is sorted, so only the pixels in the window need to
+        # be compared against the masked ranges.
+        i1 = dispersion.searchsorted(lower_wavelength - window, side="left")
+        i2 = dispersion.searchsorted(upper_wavelength + window, side="right")
+        window_dispersion = dispersion[i1:i2]
+        key = (i1, i2, tuple(window_dispersion[[0, -1]]) if i2 > i1 else (),
+               tuple([tuple(region) for region in self.metadata["mask"]]))
+        cached = getattr(self, "_mask_cache", None)
+        if cached is not None and cached[0] == key:
+            window_mask = cached[1]
+        else:
+            window_mask = np.ones(window_dispersion.size, dtype=bool)
 
-        # Any masked ranges specified in the metadata?
-        for start, end in self.metadata["mask"]:
-            mask *= ~((spectrum.dispersion >= start) \
-                     * (spectrum.dispersion <= end))
+            # Any masked ranges specified in the metadata?
+            for start, end in self.metadata["mask"]:
+                window_mask *= ~((window_dispersion >= start) \
+                                * (window_dispersion <= end))
+            self._mask_cache = (key, window_mask)
 
+        mask = np.zeros(dispersion.size, dtype=bool)
+        mask[i1:i2] = window_mask
         return mask
 
 
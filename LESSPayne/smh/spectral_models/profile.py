@@ -16,10 +16,10 @@ from astropy.table import Row
 from astropy.constants import c as speed_of_light
 from collections import OrderedDict
 from scipy.special import wofz
-from scipy import integrate
 
 from .base import BaseSpectralModel
 from LESSPayne.specutils import Spectrum1D
+from LESSPayne.utils import njit
 from ..linelists import LineList
 
 logger = logging.getLogger(__name__)
@@ -67,20 +67,38 @@ def _voigt(x, *parameters):
     :param parameters:
         The position, fwhm, amplitude, and shape of the Voigt profile.
     """
-    try:
-        n = len(x)
-    except TypeError:
-        n = 1
-
     position, fwhm, amplitude, shape = parameters
     
-    profile = 1 / wofz(np.zeros((n)) + 1j * np.sqrt(np.log(2.0)) * shape).real
-    profile *= amplitude * wofz(2*np.sqrt(np.log(2.0)) * (x - position)/fwhm \
+    profile = 1 / wofz(1j * np.sqrt(np.log(2.0)) * shape).real
+    profile = profile * amplitude * wofz(2*np.sqrt(np.log(2.0)) * (x - position)/fwhm \
         + 1j * np.sqrt(np.log(2.0))*shape).real
     return profile
 
 
 
+@njit(cache=True, fastmath=True)
+def _gaussian_model(x, position, sigma, amplitude, coefficients):
+    """
+    Evaluate an absorption Gaussian times a polynomial continuum at x:
+
+        y = (1 - amplitude * exp(-(x - position)**2 / (2.0 * sigma**2))) * continuum
+
+    This is the function evaluated for every step of a Gaussian profile fit,
+    so it is compiled with numba (if available) into a single pass over x.
+
+    :param coefficients:
+        The continuum polynomial coefficients (highest order first, as in
+        np.polyval). If empty, the continuum is 1.
+    """
+    y = 1.0 - amplitude * np.exp(-(x - position)**2 / (2.0 * sigma**2))
+    if coefficients.size == 0:
+        return y
+    continuum = np.zeros_like(x)
+    for coefficient in coefficients:
+        continuum = continuum * x + coefficient
+    return y * continuum
+
+
 class ProfileFittingModel(BaseSpectralModel):
 
     _profiles = {
@@ -340,11 +358,17 @@ class ProfileFittingModel(BaseSpectralModel):
             The observed spectrum to fit the profile transition model. If None
             is given, this will default to the normalized rest-frame spectrum in
             the parent session.
+
+        :returns:
+            The fitted result, or False if the fit failed. The reason for a
+            failed fit is stored in `self.fit_error`.
         """
 
-        spectrum = self._verify_spectrum(spectrum)
-        
-        failure = False
+        self.fit_error = None
+        try:
+            spectrum = self._verify_spectrum(spectrum)
+        except ValueError as e:
+            return self._fit_failed(str(e))
 
         # Update internal metadata with any input parameters.
         # Ignore additional parameters because other BaseSpectralModels will
@@ -377,13 +401,7 @@ class ProfileFittingModel(BaseSpectralModel):
         for iteration in range(self.metadata["max_iterations"]):
                 
             if not any(iterative_mask):
-                self.metadata["is_acceptable"] = False
-                try:
-                    del self.metadata["fitted_result"]
-                except KeyError:
-                    None
-
-                return failure
+                return self._fit_failed("no unmasked pixels to fit")
 
             try:
                 p_opt, p_cov = op.curve_fit(self.fitting_function, 
@@ -392,19 +410,13 @@ class ProfileFittingModel(BaseSpectralModel):
                     sigma=yerr[iterative_mask],
                     p0=p0, absolute_sigma=absolute_sigma)
 
-            except:
+            except Exception as e:
                 logger.exception(
                     "Exception raised in fitting atomic transition {0} "\
                     "on iteration {1}".format(self, iteration))
 
                 if iteration == 0:
-                    self.metadata["is_acceptable"] = False
-                    try:
-                        del self.metadata["fitted_result"]
-                    except KeyError:
-                        None
-
-                    return failure
+                    return self._fit_failed(str(e))
 
             # Look for outliers peaks.
             # TODO: use continuum or model?
@@ -483,11 +495,14 @@ class ProfileFittingModel(BaseSpectralModel):
 
         # Finished looking for neighbouring lines
         # `max_iterations` rounds of removing nearby lines. Now do final fit:
-        p_opt, p_cov = op.curve_fit(self.fitting_function, 
-            xdata=x[iterative_mask],
-            ydata=y[iterative_mask],
-            sigma=yerr[iterative_mask],
-            p0=p0, absolute_sigma=absolute_sigma)
+        try:
+            p_opt, p_cov = op.curve_fit(self.fitting_function, 
+                xdata=x[iterative_mask],
+                ydata=y[iterative_mask],
+                sigma=yerr[iterative_mask],
+                p0=p0, absolute_sigma=absolute_sigma)
+        except Exception as e:
+            return self._fit_failed(str(e))
 
         assert p_cov is not None
 
@@ -510,14 +525,19 @@ class ProfileFittingModel(BaseSpectralModel):
 
         else:
             N, integrate_sigma = (len(_), kwargs.pop("integrate_sigma", 10))
+            integrate_points = kwargs.pop("integrate_points", 1001)
             l, u = (
                 p_opt[0] - integrate_sigma * p_opt[1],
                 p_opt[0] + integrate_sigma * p_opt[1]
             )
 
-            ew = np.abs(integrate.quad(profile, l, u, args=tuple(p_opt[:N]))[0])
-            ew_alt = np.abs([integrate.quad(profile, l, u, args=tuple(_[:N]))[0] \
-                for _ in p_alt])
+            # Integrate the best fit and all draws at once with the
+            # trapezoidal rule on a common grid.
+            x_int, h = np.linspace(l, u, integrate_points, retstep=True)
+            p_all = np.vstack([p_opt, p_alt])
+            y_int = profile(x_int, *[p_all[:, [i]] for i in range(N)])
+            ew_all = np.abs(h * (y_int.sum(axis=1) - 0.5 * (y_int[:, 0] + y_int[:, -1])))
+            ew, ew_alt = ew_all[0], ew_all[1:]
             ew_uncertainty = np.percentile(ew_alt, percentiles) - ew
         
         # Calculate chi-square for the points that we modelled.
@@ -533,7 +553,7 @@ class ProfileFittingModel(BaseSpectralModel):
 
         model_y = self(x, *p_opt)
         model_yerr = np.percentile(
-            [self(x, *_) for _ in p_alt], percentiles, axis=0) - model_y
+            self._evaluate_draws(x, p_alt), percentiles, axis=0) - model_y
         model_yerr = np.max(np.abs(model_yerr), axis=0)
 
         ### DEBUG PLOT
@@ -565,7 +585,7 @@ class ProfileFittingModel(BaseSpectralModel):
             y = spectrum.flux[indices[0]:1 + indices[-1]]
             model_y = self(x, *p_opt)
             model_yerr = np.percentile(
-                [self(x, *_) for _ in p_alt], percentiles, axis=0) - model_y
+                self._evaluate_draws(x, p_alt), percentiles, axis=0) - model_y
             model_yerr = np.max(np.abs(model_yerr), axis=0)
             residuals = y - model_y
         else:
@@ -606,6 +626,19 @@ class ProfileFittingModel(BaseSpectralModel):
         return self.metadata["fitted_result"]
 
 
+    def _fit_failed(self, reason):
+        """
+        Mark the model as unfitted after a failed fit and return False.
+
+        :param reason:
+            A description of why the fit failed, stored in `self.fit_error`.
+        """
+        self.fit_error = reason
+        self.metadata["is_acceptable"] = False
+        self.metadata.pop("fitted_result", None)
+        return False
+
+
     def montecarlo_fit(self, N=100, **kwargs):
         """
         Run a fit N times using spectrum ivar and report the resulting median and scatter
@@ -751,6 +784,11 @@ class ProfileFittingModel(BaseSpectralModel):
         function, profile_parameters = self._profiles[self.metadata["profile"]]
 
         N = len(profile_parameters)
+        if function == _gaussian:
+            return _gaussian_model(np.asarray(dispersion, dtype=float),
+                float(parameters[0]), float(parameters[1]), float(parameters[2]),
+                np.asarray(parameters[N:], dtype=float))
+
         y = 1.0 - function(dispersion, *parameters[:N])
 
         # Assume rest of the parameters are continuum coefficients.
@@ -759,3 +797,32 @@ class ProfileFittingModel(BaseSpectralModel):
         
         return y
 
+
+    def _evaluate_draws(self, dispersion, draws):
+        """
+        Generate data at the dispersion points for many sets of parameters at
+        once, e.g., draws from the covariance matrix.
+
+        :param dispersion:
+            An array of dispersion points to calculate the data for.
+
+        :param draws:
+            A (num_draws, num_parameters) array of model parameters.
+
+        :returns:
+            A (num_draws, len(dispersion)) array.
+        """
+
+        function, profile_parameters = self._profiles[self.metadata["profile"]]
+
+        N = len(profile_parameters)
+        draws = np.atleast_2d(draws)
+        columns = [draws[:, [i]] for i in range(draws.shape[1])]
+        y = 1.0 - function(np.asarray(dispersion), *columns[:N])
+
+        # Assume rest of the parameters are continuum coefficients.
+        if columns[N:]:
+            y = y * np.polyval(columns[N:], dispersion)
+
+        return y
+
@@ -366,7 +366,7 @@ def mask_tellurics(orders, telluric_regions):
     # Mask tellurics
     for order in orders:
         wave = order.dispersion
-        ivar = order.ivar
+        ivar = order.ivar.copy() # the order may share its ivar array
         for wl1,wl2 in telluric_regions:
             ivar[(wl1 < wave) & (wave < wl2)] = 0.
         order._ivar = ivar
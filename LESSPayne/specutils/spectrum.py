@@ -5,24 +5,393 @@
 
 from __future__ import (division, print_function, absolute_import,
                         unicode_literals)
-from six import iteritems
 
-__all__ = ["Spectrum1D", "stitch", "coadd", "read_mike_spectrum", "write_fits_linear"]
+__all__ = ["Spectrum1D", "SpectrumOrders", "stitch", "coadd", "read_mike_spectrum", "write_fits_linear"]
 
 import logging
 import numpy as np
 import os
 import re
 from collections import OrderedDict
+from functools import lru_cache
 from hashlib import md5
 
 from astropy.io import fits
 from astropy.stats import biweight_scale
-from scipy import interpolate, ndimage, polyfit, poly1d, optimize as op, signal
+try:
+    import fitsio
+except ImportError:
+    # fitsio (cfitsio) is optional and only used to speed up FITS reads
+    fitsio = None
+try:
+    import pandas as pd
+except ImportError:
+    # pandas is optional and only used to speed up ASCII reads
+    pd = None
+from scipy import interpolate, ndimage, optimize as op
+from ..utils import njit, HAS_NUMBA as _HAS_NUMBA
 from .robust_polyfit import polyfit as rpolyfit
 
 logger = logging.getLogger(__name__)
 
+c = 299792458e-3 # km/s
+_inv_c = 1.0/c
+
+def _loadtxt(path, usecols, skiprows=0, **kwargs):
+    """
+    Read whitespace-separated columns from an ASCII file and return them
+    unpacked (one array per column), like `np.loadtxt(..., unpack=True)`.
+
+    pandas' C parser is much faster and lighter on memory than `np.loadtxt`
+    for large files, so it is used when available and no other `np.loadtxt`
+    options were given.
+    """
+    kwargs.pop("unpack", None)
+    if pd is None or kwargs:
+        return np.loadtxt(path, usecols=usecols, skiprows=skiprows,
+            unpack=True, **kwargs)
+
+    # (pandas ignores the order of usecols, so index the columns explicitly)
+    usecols = list(usecols)
+    table = pd.read_csv(path, sep=r"\s+", header=None, usecols=usecols,
+        skiprows=skiprows, comment="#", dtype=np.float64, engine="c")
+    return table[usecols].to_numpy().T
+
+
+def _noise_to_ivar(noise):
+    """
+    Convert a noise (standard deviation) array into an inverse variance array.
+
+    This is equivalent to `noise**(-2)`, but squares and takes the reciprocal
+    in place instead of going through the generic power function.
+    """
+    ivar = np.square(noise, dtype=np.result_type(noise, 1.0))
+    return np.divide(1.0, ivar, out=ivar)
+
+
+def _bin_edges(dispersion):
+    """
+    Return the pixel edges for the given pixel centers, extrapolating the
+    first and last pixels by half of their neighbouring spacing.
+    """
+    edges = np.empty(dispersion.size + 1)
+    edges[1:-1] = 0.5 * (dispersion[1:] + dispersion[:-1])
+    edges[0] = 1.5 * dispersion[0] - 0.5 * dispersion[1]
+    edges[-1] = 1.5 * dispersion[-1] - 0.5 * dispersion[-2]
+    return edges
+
+
+def _rebin_flux_conserving(new_dispersion, dispersion, flux, ivar,
+    fill_value=0.):
+    """
+    Rebin flux and inverse variance onto a new dispersion, conserving flux.
+
+    One search over the old pixel edges gives the overlap of every new pixel
+    with the old ones, which is used for both the flux and the variance. New
+    pixels that are not fully covered by the old dispersion are set to
+    `fill_value`.
+
+    :returns:
+        A two-length tuple containing the new flux and inverse variance.
+    """
+
+    new_dispersion = np.asarray(new_dispersion, dtype=float)
+    old_edges = _bin_edges(np.asarray(dispersion, dtype=float))
+    new_edges = _bin_edges(new_dispersion)
+    old_widths = np.diff(old_edges)
+
+    # Pixels with non-finite flux or no (or invalid) ivar are left out of the
+    # sums, and flag any new pixel that overlaps them.
+    flux = np.asarray(flux, dtype=float)
+    ivar = np.asarray(ivar, dtype=float)
+    bad_flux = ~np.isfinite(flux)
+    bad_ivar = ~(ivar > 0)
+    flux = np.where(bad_flux, 0, flux)
+    with np.errstate(divide="ignore"):
+        variance = np.where(bad_ivar, 0, 1.0/ivar)
+
+    # Cumulative sums over whole old pixels, for the pixels in between.
+    cum_flux = np.concatenate([[0], np.cumsum(old_widths * flux)])
+    cum_var = np.concatenate([[0], np.cumsum(old_widths**2 * variance)])
+    cum_bad_flux = np.concatenate([[0], np.cumsum(bad_flux)])
+    cum_bad_ivar = np.concatenate([[0], np.cumsum(bad_ivar)])
+
+    # The old pixel holding each edge of each new pixel.
+    idx = np.searchsorted(old_edges, new_edges, side="right") - 1
+    covered = (idx[:-1] >= 0) & (idx[1:] < old_widths.size) \
+        & (new_edges[1:] <= old_edges[-1])
+    lo = idx[:-1].clip(0, old_widths.size - 1)
+    hi = idx[1:].clip(0, old_widths.size - 1)
+    start, end = new_edges[:-1], new_edges[1:]
+
+    # Partial overlap with the first and last old pixel of each new pixel.
+    same = (lo == hi)
+    first = np.where(same, end, old_edges[lo + 1]) - start
+    last = np.where(same, 0, end - old_edges[hi])
+    inner = np.maximum(hi - lo - 1, 0)
+    inner_lo = np.minimum(lo + 1, hi)
+
+    new_widths = end - start
+    new_flux = (first * flux[lo] + last * flux[hi] \
+        + cum_flux[inner_lo + inner] - cum_flux[inner_lo]) / new_widths
+    new_variance = first**2 * variance[lo] + last**2 * variance[hi] \
+        + cum_var[inner_lo + inner] - cum_var[inner_lo]
+    with np.errstate(divide="ignore"):
+        new_ivar = new_widths**2 / new_variance
+
+    # The old pixels overlapping each new pixel are lo, ..., hi (or hi - 1,
+    # if the new pixel ends exactly on an old edge).
+    stop = hi + (last > 0)
+    new_flux[cum_bad_flux[stop] > cum_bad_flux[lo]] = np.nan
+    new_ivar[cum_bad_ivar[stop] > cum_bad_ivar[lo]] = 0
+
+    new_flux[~covered] = fill_value
+    new_ivar[~covered] = fill_value
+    return (new_flux, new_ivar)
+
+
+@lru_cache(maxsize=64)
+def _gaussian_kernel(sigma, truncate=4.0):
+    """
+    Return the normalized Gaussian kernel used by `ndimage.gaussian_filter1d`
+    for the given sigma (in pixels) and truncation, so that repeated
+    smoothing with the same width does not rebuild it.
+    """
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 / sigma**2 * x**2)
+    kernel /= kernel.sum()
+    kernel.flags.writeable = False
+    return kernel
+
+
+def regions_to_mask(dispersion, regions, inclusive=False):
+    """
+    Return a boolean mask of the (sorted) dispersion pixels inside any of the
+    given (start, end) regions, or inside a single region if two floats are
+    given.
+
+    :param dispersion:
+        The sorted dispersion array.
+
+    :param regions:
+        A (start, end) pair or a sequence of them.
+
+    :param inclusive: [optional]
+        Which region ends count as inside. `False` keeps start < x < end,
+        `True` keeps start <= x <= end, and `"left"` keeps start <= x < end
+        (the pixels in `range(*np.searchsorted(dispersion, region))`).
+    """
+    if inclusive not in (True, False, "left"):
+        raise ValueError("inclusive must be True, False or 'left'")
+
+    # (two floats are a single region, so this handles both forms)
+    regions = np.asarray(regions, dtype=float).reshape(-1, 2)
+
+    # Count region starts and ends at each pixel in one searchsorted call per
+    # side; pixels with a positive running count are inside some region.
+    starts = np.searchsorted(dispersion, regions[:, 0],
+        side="right" if inclusive is False else "left")
+    ends = np.searchsorted(dispersion, regions[:, 1],
+        side="right" if inclusive is True else "left")
+    ok = ends > starts
+    counts = np.zeros(len(dispersion) + 1, dtype=int)
+    np.add.at(counts, starts[ok], 1)
+    np.add.at(counts, ends[ok], -1)
+    return np.cumsum(counts[:-1]) > 0
+
+
+@lru_cache(maxsize=32)
+def _knot_grid(start, end, knot_spacing):
+    """
+    Return the evenly spaced spline knots between `start` and `end`, centred
+    so that the spacing left over at either end is the same. Continuum fits
+    are repeated many times on the same dispersion, so the grid is cached
+    (as a read-only array).
+    """
+    end_spacing = ((end - start) % knot_spacing) /2.
+    if knot_spacing/2. > end_spacing: end_spacing += knot_spacing/2.
+        
+    knots = np.arange(start + end_spacing, end - end_spacing + knot_spacing,
+        knot_spacing)
+    knots.flags.writeable = False
+    return knots
+
+
+def _continuum_knots(dispersion, knot_spacing, first, last):
+    """
+    Return the spline knots for a continuum fit over `dispersion`, keeping
+    only those within the first and last continuum pixel wavelengths.
+    """
+    knots = _knot_grid(float(dispersion[0]), float(dispersion[-1]),
+        float(knot_spacing))
+
+    if len(knots) > 0 and knots[-1] > last:
+        knots = knots[:knots.searchsorted(last)]
+        
+    if len(knots) > 0 and knots[0] < first:
+        knots = knots[knots.searchsorted(first):]
+    return knots
+
+
+def _header_to_metadata(cards):
+    """
+    Merge FITS header cards into a metadata dictionary.
+
+    Keywords that appear more than once (e.g., HISTORY, COMMENT, blank) have
+    their values concatenated. The repeated values are collected first and
+    joined once at the end, instead of growing a string card by card.
+
+    :param cards:
+        An iterable of (keyword, value) pairs, e.g. `header.items()`.
+    """
+    metadata = OrderedDict()
+    repeated = OrderedDict()
+    for key, value in cards:
+        if key in metadata:
+            repeated.setdefault(key, [metadata[key]]).append(value)
+        else:
+            metadata[key] = value
+
+    for key, values in repeated.items():
+        if all(isinstance(value, str) for value in values):
+            metadata[key] = "".join(values)
+            continue
+        merged = values[0]
+        for value in values[1:]:
+            try:
+                merged += value
+            except:
+                merged += str(value)
+        metadata[key] = merged
+    return metadata
+
+def _read_header(path):
+    """
+    Read the primary header of a FITS file into a metadata dictionary.
+
+    This always uses astropy (not fitsio), so that the metadata (card values
+    and types, and the merging of blank/COMMENT/HISTORY cards) does not depend
+    on which optional packages are installed.
+
+    :param path:
+        The path of the FITS file.
+    """
+    return _header_to_metadata(fits.getheader(path).items())
+
+
+def _read_bands(path, bands, hdu=None):
+    """
+    Read bands (indices along the first axis) of the primary image of a FITS
+    file. Only the requested bands are read from disk.
+
+    :param path:
+        The path of the FITS file.
+
+    :param bands:
+        An iterable of (zero-indexed) band numbers.
+
+    :param hdu: [optional]
+        The already opened (astropy) primary HDU of `path`. The bands are then
+        read through its `section` instead of opening the file again.
+
+    Otherwise fitsio is used if it is available. Either way, band numbers
+    follow numpy indexing: negative bands count from the end and bands out of
+    range raise an IndexError.
+    """
+    if hdu is not None:
+        return [hdu.section[band] for band in bands]
+    if fitsio is None:
+        with fits.open(path, memmap=True, lazy_load_hdus=True) as image:
+            return [image[0].section[band] for band in bands]
+    with fitsio.FITS(path) as image:
+        dims = image[0].get_dims()
+        data = []
+        for band in bands:
+            if not -dims[0] <= band < dims[0]:
+                raise IndexError("band {} is out of range for an image with "
+                    "{} bands".format(band, dims[0]))
+            band %= dims[0]
+            data.append(image[0][(slice(band, band + 1), ) \
+                + (slice(None), ) * (len(dims) - 1)][0])
+        return data
+
+
+# Splits the concatenated WAT2 string into one 'specN = "..."' value per order
+_SPEC_SPLIT_RE = re.compile(r'spec[0-9]+ ?= ?"')
+
+def _numbered_values(metadata, key_fmt, start):
+    """
+    Return the values of the consecutively numbered header keywords
+    `key_fmt.format(start)`, `key_fmt.format(start + 1)`, ... up to the first
+    one that is missing. Each keyword is formatted only once.
+    """
+    values = []
+    while True:
+        key = key_fmt.format(start + len(values))
+        if key not in metadata:
+            return values
+        values.append(metadata[key])
+
+
+def _concatenate_wat(metadata, wat_length=68):
+    """
+    Join the WAT2_001, WAT2_002, ... header values for the multispec
+    dispersion mapping, padding each to `wat_length` characters.
+
+    :param metadata:
+        The metadata dictionary of the header.
+
+    :param wat_length: [optional]
+        The length of each WAT card value. The multispec format uses 68, but
+        some files are broken.
+    """
+    values = _numbered_values(metadata, "WAT2_{0:03d}", 1)
+    return "".join([value.ljust(wat_length) for value in values])
+
+
+def _parse_order_mapping(concatenated_wat):
+    """
+    Split a concatenated WAT2 string into the dispersion mapping parameters
+    of each order (one array per order, as passed to `compute_dispersion`).
+
+    Non-linear orders can have different numbers of parameters, so this is a
+    list rather than a (ragged) 2D array.
+    """
+    return [np.array(each.rstrip('" ').split(), dtype=float) \
+        for each in _SPEC_SPLIT_RE.split(concatenated_wat)[1:]]
+
+
+# Known multi-spec data products, keyed by the md5 hash of their BANDID values
+# (see `_bandid_hash`): (name, default flux band, default noise band), where
+# the bands are zero-indexed.
+_MULTISPEC_PRODUCTS = {
+    "0da149208a3c8ba608226544605ed600": ("CarPy", 1, 2), # MIKE
+    "e802331006006930ee0e60c7fbc66cec": ("CarPy", 1, 2), # MIKE (old)
+    "6b2c2ec1c4e1b122ccab15eb9bd305bc": ("CarPy", 1, 2), # MagE
+    "2ab648afed96dcff5ccd10e5b45730c1": ("CarPy", 1, 2), # du Pont
+    "a4d8f6f51a7260fce1642f7b42012969": ("IRAF 3band", 0, 2),
+}
+
+
+def _bandid_hash(metadata):
+    """
+    Return the md5 hex digest of the ";"-joined BANDID header values, which
+    identifies the data product (band layout) of a multi-spec file.
+
+    The hash is updated value by value rather than on one joined string; the
+    digest is the same, so the known product hashes remain valid.
+    """
+    h = md5()
+    separator = b""
+    for key, value in metadata.items():
+        if key.startswith("BANDID"):
+            h.update(separator)
+            h.update(value.encode("utf-8"))
+            separator = b";"
+    return h.hexdigest()
+
+
 class Spectrum1D(object):
     """ A one-dimensional spectrum. """
 
@@ -45,36 +414,38 @@ class Spectrum1D(object):
             A dictionary containing metadata for this spectrum.
         """
 
-        dispersion = np.array(dispersion)
-        flux = np.array(flux)
-        ivar = np.array(ivar)
+        # No copies are made of arrays that are given (use .copy() for that),
+        # so spectra may share arrays: methods must rebind, not modify in place.
+        dispersion = np.asarray(dispersion)
+        flux = np.asarray(flux)
+        ivar = np.asarray(ivar)
 
-        if max([len(_.shape) for _ in (dispersion, flux, ivar)]) > 1:
+        if max(dispersion.ndim, flux.ndim, ivar.ndim) > 1:
             raise ValueError(
                 "dispersion, flux and ivar must be one dimensional arrays")
         
-        if flux.size != dispersion.size:
-            raise ValueError(
-                "dispersion and flux arrays must have the same "
-                "size ({0} != {1})".format(dispersion.size, flux.size, ))
-
-        if ivar.size != dispersion.size:
+        if not (dispersion.size == flux.size == ivar.size):
             raise ValueError(
-                "dispersion and ivar arrays must have the same "
-                "size ({0} != {1})".format(dispersion.size, ivar.size, ))
+                "dispersion, flux and ivar arrays must have the same "
+                "size ({0}, {1}, {2})".format(
+                    dispersion.size, flux.size, ivar.size))
 
         self.metadata = metadata or {}
 
         # Don't allow orders to be back-to-front.
-        if np.all(np.diff(dispersion) < 0):
+        # (dispersions are monotonic, so comparing the end points is enough)
+        if dispersion.size > 1 and dispersion[0] > dispersion[-1]:
             dispersion = dispersion[::-1]
             flux = flux[::-1]
             ivar = ivar[::-1]
 
         # HACK so that *something* can be done with spectra when there is no
         # inverse variance array.
-        if not np.any(np.isfinite(ivar)) or np.nanmax(ivar) == 0:
-            ivar = np.ones_like(flux) * 1.0/np.nanmean(flux)
+        # (fmax ignores NaNs; only a non-finite maximum needs the second pass)
+        max_ivar = np.fmax.reduce(ivar) if ivar.size else np.nan
+        if max_ivar == 0 \
+        or (not np.isfinite(max_ivar) and not np.any(np.isfinite(ivar))):
+            ivar = np.full(flux.shape, 1.0/np.nanmean(flux))
 
         self._dispersion = dispersion
         self._flux = flux
@@ -136,8 +507,12 @@ class Spectrum1D(object):
                 continue
 
             else:
-                orders = [cls(dispersion=d, flux=f, ivar=i, metadata=metadata) \
-                    for d, f, i in zip(dispersion, flux, ivar)]
+                if SpectrumOrders.can_hold(dispersion, flux, ivar):
+                    orders = SpectrumOrders(dispersion, flux, ivar,
+                        metadata=metadata, klass=cls)
+                else:
+                    orders = [cls(dispersion=d, flux=f, ivar=i, metadata=metadata) \
+                        for d, f, i in zip(dispersion, flux, ivar)]
                 break
         else:
             raise ValueError("cannot read spectrum from path {}".format(path))
@@ -149,23 +524,14 @@ class Spectrum1D(object):
 
     @classmethod
     def read_alex_spectrum(cls, path):
-        image = fits.open(path)
-
         # Merge headers into a metadata dictionary.
-        metadata = OrderedDict()
-        for key, value in image[0].header.items():
-            if key in metadata:
-                metadata[key] += value
-            else:
-                metadata[key] = value
+        metadata = _read_header(path)
         metadata["smh_read_path"] = path
         
-        md5_hash = md5(";".join([v for k, v in metadata.items() \
-                                 if k.startswith("BANDID")]).encode("utf-8")).hexdigest()
+        md5_hash = _bandid_hash(metadata)
         assert md5_hash == "8538046d98bf8a760b04690e53e394a1"
 
-        data = image[0].data
-        waves, fluxs, ivars = data[0], data[1], data[2]
+        waves, fluxs, ivars = _read_bands(path, range(3))
 
         return (waves, fluxs, ivars, metadata)
 
@@ -179,20 +545,16 @@ class Spectrum1D(object):
             print(Npix)
             print("Padding with last wavelength of each order, zero flux, zero ivar")
         Npix = np.max(Npix)
-        wave, flux, ivar = np.zeros((Nspec,Npix)), np.zeros((Nspec,Npix)), np.zeros((Nspec,Npix))
-        for i, spec in enumerate(specs):
-            N = len(spec.dispersion)
-            wave[i,0:N] = spec.dispersion
-            flux[i,0:N] = spec.flux
-            ivar[i,0:N] = spec.ivar
-            if N < Npix: wave[i,N:Npix] = spec.dispersion[-1]
-        #wave = np.array([spec.dispersion for spec in specs])
-        #flux = np.array([spec.flux for spec in specs])
-        #ivar = np.array([spec.ivar for spec in specs])
         
         ### Write a 3 extension fits file: wave, flux, ivar
-        # make the output array: 3 x Norder x Npix
-        outdata = np.array([wave, flux, ivar], dtype=float)
+        # make the output array: 3 x Norder x Npix, filled in place
+        outdata = np.zeros((3, Nspec, Npix))
+        for i, spec in enumerate(specs):
+            N = len(spec.dispersion)
+            outdata[0,i,0:N] = spec.dispersion
+            outdata[0,i,N:Npix] = spec.dispersion[-1]
+            outdata[1,i,0:N] = spec.flux
+            outdata[2,i,0:N] = spec.ivar
 
         hdu = fits.PrimaryHDU(outdata)
         
@@ -221,17 +583,15 @@ class Spectrum1D(object):
 
     @classmethod
     def read_ceres(cls, fname):
-        with fits.open(fname) as hdul:
+        with fits.open(fname, memmap=True, lazy_load_hdus=True) as hdul:
             assert len(hdul)==1, len(hdul)
             header = hdul[0].header
             assert header["PIPELINE"] == "CERES", header["PIPELINE"]
-            data = hdul[0].data
-            Nband, Norder, Npix = data.shape
+            Nband, Norder, Npix = hdul[0].shape
             # https://github.com/rabrahm/ceres
             # by default it looks sorted from red to blue orders, so we'll flip it in the output
-            waves = data[0,::-1,:]
-            fluxs = data[1,::-1,:]
-            ivars = data[2,::-1,:]
+            # (only the three bands used are read from disk)
+            waves, fluxs, ivars = [band[::-1,:] for band in _read_bands(fname, range(3), hdul[0])]
             # 3, 4 = blaze corrected flux and error
             # 5, 6 = continuum normalized flux and error
             # 7 = continuum
@@ -239,12 +599,7 @@ class Spectrum1D(object):
             # 9, 10 = Continumm normalized flux multiplied by the derivative of the wavelength with respect to the pixels + err
 
             # Merge headers into a metadata dictionary.
-            metadata = OrderedDict()
-            for key, value in header.items():
-                if key in metadata:
-                    metadata[key] += value
-                else:
-                    metadata[key] = value
+            metadata = _header_to_metadata(header.items())
             metadata["smh_read_path"] = fname
         return (waves, fluxs, ivars, metadata)
 
@@ -261,56 +616,52 @@ class Spectrum1D(object):
         else:
             WAT_LENGTH=68
         
-        try:
-            orders = cls.read(fname, WAT_LENGTH=WAT_LENGTH)
-            code = 1
-        except:
-            print("OLD FORMAT STARTING")
-            # This is the old format: (Norders x Npix) with no noise spec...
-            with fits.open(fname) as hdulist:
-                assert len(hdulist)==1, len(hdulist)
-                header = hdulist[0].header
-                data = hdulist[0].data
-                # orders x pixels
-                assert len(data.shape)==2, data.shape
-                
-                metadata = OrderedDict()
-                for k, v in header.items():
-                    if k in metadata:
-                        metadata[k] += v
-                    else:
-                        metadata[k] = v
-
-            ## Compute dispersion
-            assert metadata["CTYPE1"].upper().startswith("MULTISPE") \
-                or metadata["WAT0_001"].lower() == "system=multispec"
-
-            # Join the WAT keywords for dispersion mapping.
-            i, concatenated_wat, key_fmt = (1, str(""), "WAT2_{0:03d}")
-            while key_fmt.format(i) in metadata:
-                value = metadata[key_fmt.format(i)]
-                concatenated_wat += value + (" "  * (68 - len(value)))
-                i += 1
-
-            # Split the concatenated header into individual orders.
-            order_mapping = np.array([list(map(float, each.rstrip('" ').split())) \
-                for each in re.split('spec[0-9]+ ?= ?"', concatenated_wat)[1:]])
-            print(order_mapping)
-            if len(order_mapping)==0:
-                NAXIS1 = metadata["NAXIS1"]
-                NAXIS2 = metadata["NAXIS2"]
-                dispersion = np.array([np.arange(NAXIS1) for _ in range(NAXIS2)])
-            else:
-                dispersion = np.array(
-                    [compute_dispersion(*mapping) for 
-                     mapping in order_mapping])
-            
-            ## Compute flux
-            flux = data
-            #flux[0 > flux] = np.nan
-            
-            ## Compute ivar assuming Poisson noise
-            ivar = 1./flux
+        # Open the file once, and use the same HDU list for both formats.
+        with fits.open(fname, memmap=True, lazy_load_hdus=True) as hdulist:
+            try:
+                return cls._parse_fits_multispec(hdulist, fname,
+                    WAT_LENGTH=WAT_LENGTH)
+            except Exception:
+                print("OLD FORMAT STARTING")
+                return cls._parse_old_multispec(hdulist)
+
+
+    @staticmethod
+    def _parse_old_multispec(hdulist):
+        """
+        Parse an old format (Norders x Npix, with no noise spectrum) multi-spec
+        file from an already opened HDU list, assuming Poisson noise.
+        """
+        # This is the old format: (Norders x Npix) with no noise spec...
+        assert len(hdulist)==1, len(hdulist)
+        header = hdulist[0].header
+        data = hdulist[0].data
+        # orders x pixels
+        assert len(data.shape)==2, data.shape
+        
+        metadata = _header_to_metadata(header.items())
+
+        ## Compute dispersion
+        assert metadata["CTYPE1"].upper().startswith("MULTISPE") \
+            or metadata["WAT0_001"].lower() == "system=multispec"
+
+        # Join the WAT keywords for dispersion mapping.
+        concatenated_wat = _concatenate_wat(metadata)
+
+        NAXIS1 = metadata["NAXIS1"]
+        NAXIS2 = metadata["NAXIS2"]
+        if _SPEC_SPLIT_RE.search(concatenated_wat) is None:
+            dispersion = np.array([np.arange(NAXIS1) for _ in range(NAXIS2)])
+        else:
+            dispersion = _dispersion_from_wat(
+                concatenated_wat, NAXIS2, NAXIS1)
+        
+        ## Compute flux
+        flux = data
+        #flux[0 > flux] = np.nan
+        
+        ## Compute ivar assuming Poisson noise
+        ivar = 1./flux
             
         return (dispersion, flux, ivar, metadata)
 
@@ -334,138 +685,84 @@ class Spectrum1D(object):
             The multispec format fits uses 68, but some files are broken
         """
 
-        image = fits.open(path)
+        with fits.open(path, memmap=True, lazy_load_hdus=True) as image:
+            return cls._parse_fits_multispec(image, path, flux_ext=flux_ext,
+                ivar_ext=ivar_ext, WAT_LENGTH=WAT_LENGTH,
+                override_bad=override_bad)
 
-        # Merge headers into a metadata dictionary.
-        metadata = OrderedDict()
-        for key, value in image[0].header.items():
 
-            # NOTE: In the old SMH we did a try-except block to string-ify and
-            #       JSON-dump the header values, and if they could not be
-            #       forced to a string we didn't keep that header.
+    @classmethod
+    def _parse_fits_multispec(cls, image, path, flux_ext=None, ivar_ext=None,
+                              WAT_LENGTH=68, override_bad=False):
+        """
+        Parse the dispersion, flux and inverse variance of a multi-spec file
+        from an already opened HDU list (see `read_fits_multispec`).
+        """
 
-            #       I can't remember what types caused that problem, but it was
-            #       to prevent SMH being unable to save a session.
-            
-            #       Since we are pickling now, that shouldn't be a problem
-            #       anymore, but this note is here to speed up debugging in case
-            #       that issue returns.
+        # Merge headers into a metadata dictionary.
+        # NOTE: In the old SMH we did a try-except block to string-ify and
+        #       JSON-dump the header values, and if they could not be
+        #       forced to a string we didn't keep that header.
 
-            if key in metadata:
-                try:
-                    metadata[key] += value
-                except:
-                    metadata[key] += str(value)
-            else:
-                metadata[key] = value
+        #       I can't remember what types caused that problem, but it was
+        #       to prevent SMH being unable to save a session.
 
+        #       Since we are pickling now, that shouldn't be a problem
+        #       anymore, but this note is here to speed up debugging in case
+        #       that issue returns.
+        metadata = _header_to_metadata(image[0].header.items())
         metadata["smh_read_path"] = path
 
-        flux = image[0].data
-
         assert metadata["CTYPE1"].upper().startswith("MULTISPE") \
             or metadata["WAT0_001"].lower() == "system=multispec"
 
         # Join the WAT keywords for dispersion mapping.
-        i, concatenated_wat, key_fmt = (1, str(""), "WAT2_{0:03d}")
-        while key_fmt.format(i) in metadata:
-            # .ljust(68, " ") had str/unicode issues across Python 2/3
-            value = metadata[key_fmt.format(i)]
-            concatenated_wat += value + (" "  * (WAT_LENGTH - len(value)))
-            i += 1
-
-        # Split the concatenated header into individual orders.
-        order_mapping = np.array([list(map(float, each.rstrip('" ').split())) \
-                for each in re.split('spec[0-9]+ ?= ?"', concatenated_wat)[1:]])
+        concatenated_wat = _concatenate_wat(metadata, WAT_LENGTH)
 
         # Parse the order mapping into dispersion values.
         # Do it this way to ensure ragged arrays work
         num_pixels, num_orders = metadata["NAXIS1"], metadata["NAXIS2"]
-        dispersion = np.zeros((num_orders, num_pixels), dtype=float) + np.nan
-        for j in range(num_orders):
-            _dispersion = compute_dispersion(*order_mapping[j])
-            dispersion[j,0:len(_dispersion)] = _dispersion
+        dispersion = _dispersion_from_wat(
+            concatenated_wat, num_orders, num_pixels)
         #dispersion = np.array(
         #    [compute_dispersion(*mapping) for mapping in order_mapping])
 
         # Get the flux and inverse variance arrays.
         # NOTE: Most multi-spec data previously used with SMH have been from
         #       Magellan/MIKE, and reduced with CarPy.
-        md5_hash = md5(";".join([v for k, v in metadata.items() \
-            if k.startswith("BANDID")]).encode('utf-8')).hexdigest()
-        is_carpy_mike_product = (md5_hash == "0da149208a3c8ba608226544605ed600")
-        is_carpy_mike_product_old = (md5_hash == "e802331006006930ee0e60c7fbc66cec")
-        is_carpy_mage_product = (md5_hash == "6b2c2ec1c4e1b122ccab15eb9bd305bc")
-        is_iraf_3band_product = (md5_hash == "a4d8f6f51a7260fce1642f7b42012969")
-        is_apo_product = (image[0].header.get("OBSERVAT", None) == "APO")
-        is_dupont_product = (md5_hash == "2ab648afed96dcff5ccd10e5b45730c1")
-        is_mcdonald_product = (image[0].header.get("OBSERVAT", "").strip() == "MCDONALD")
-        
-        if is_carpy_mike_product or is_carpy_mage_product or is_carpy_mike_product_old or is_dupont_product:
-            # CarPy gives a 'noise' spectrum, which we must convert to an
+        md5_hash = _bandid_hash(metadata)
+        product = _MULTISPEC_PRODUCTS.get(md5_hash)
+        observatory = image[0].header.get("OBSERVAT", "").strip()
+        if product is None and observatory in ("APO", "MCDONALD"):
+            # The noise is in band 3 for the known APO layout, else the last.
+            product = (observatory, 0,
+                3 if md5_hash == "9d008ba2c3dc15549fd8ffe8a605ec15" else -1)
+
+        if product is not None:
+            # These give a 'noise' spectrum, which we must convert to an
             # inverse variance array
-            flux_ext = flux_ext or 1
-            noise_ext = ivar_ext or 2
+            name, default_flux_ext, default_noise_ext = product
+            flux_ext = flux_ext or default_flux_ext
+            noise_ext = ivar_ext or default_noise_ext
 
             logger.info(
-                "Recognized CarPy product. Using zero-indexed flux/noise "
-                "extensions (bands) {}/{}".format(flux_ext, noise_ext))
-
-            flux = image[0].data[flux_ext]
-            if flux_ext == 6:
-                flat = image[0].data[1]/image[0].data[6]
-                ivar = (flat/image[0].data[2])**2.
+                "Recognized {} product. Using zero-indexed flux/noise "
+                "extensions (bands) {}/{}".format(name, flux_ext, noise_ext))
+            if name != "CarPy":
+                logger.info(metadata.get("BANDID{}".format(flux_ext+1)))
+                logger.info(metadata.get("BANDID{}".format(noise_ext+1)))
+
+            # Only the bands used are read from disk
+            if name == "CarPy" and flux_ext == 6:
+                flux, obj, noise = _read_bands(path, (6, 1, 2), image[0])
+                flat = obj/flux
+                ivar = (flat/noise)**2.
             else:
-                ivar = image[0].data[noise_ext]**(-2)
-            
-        elif is_iraf_3band_product:
-            flux_ext = flux_ext or 0
-            noise_ext = ivar_ext or 2
-            
-            logger.info(
-                "Recognized IRAF 3band product. Using zero-indexed flux/noise "
-                "extensions (bands) {}/{}".format(flux_ext, noise_ext))
-            logger.info(
-                image[0].header["BANDID{}".format(flux_ext+1)]
-            )
-            logger.info(
-                image[0].header["BANDID{}".format(noise_ext+1)]
-            )
-            
-            flux = image[0].data[flux_ext]
-            ivar = image[0].data[noise_ext]**(-2)
-
-        elif is_apo_product or is_mcdonald_product:
-            flux_ext = flux_ext or 0
-
-            if md5_hash == "9d008ba2c3dc15549fd8ffe8a605ec15":
-                default_ivar_ext = 3
-            elif md5_hash == "a4d8f6f51a7260fce1642f7b42012969":
-                default_ivar_ext = 2
-            else:
-                default_ivar_ext = -1
-            noise_ext = ivar_ext or default_ivar_ext
-
-            if md5_hash == "9d008ba2c3dc15549fd8ffe8a605ec15":
-                logger.info(
-                    "Recognized APO product. Using zero-indexed flux/noise "
-                    "extensions (bands) {}/{}".format(flux_ext, noise_ext))
-            elif md5_hash == "a4d8f6f51a7260fce1642f7b42012969":
-                logger.info(
-                    "Recognized McDonald product. Using zero-indexed flux/noise "
-                    "extensions (bands) {}/{}".format(flux_ext, noise_ext))
-            
-            logger.info(
-                image[0].header["BANDID{}".format(flux_ext+1)]
-            )
-            logger.info(
-                image[0].header["BANDID{}".format(noise_ext+1)]
-            )
-
-            flux = image[0].data[flux_ext]
-            ivar = image[0].data[noise_ext]**(-2)
+                flux, noise = _read_bands(path, (flux_ext, noise_ext), image[0])
+                ivar = _noise_to_ivar(noise)
 
         else:
+            flux = image[0].data
             ivar = np.full_like(flux, np.nan)
             logger.info("could not identify flux and ivar extensions "
                         "(using nan for ivar)")
@@ -490,23 +787,16 @@ class Spectrum1D(object):
                 ivar = ivar[::-1]
 
         # Do something sensible regarding zero or negative fluxes.
-        ivar[0 >= flux] = 0.000000000001
+        # (written in place through the flipped views, in a single pass)
+        np.copyto(ivar, 0.000000000001, where=(0 >= flux))
         #flux[0 >= flux] = np.nan
 
         # turn into list of arrays if it's ragged
-        if np.any(np.isnan(dispersion)):
-            newdispersion = []
-            newflux = []
-            newivar = []
-            for j in range(num_orders):
-                d = dispersion[j,:]
-                ii = np.isfinite(d)
-                newdispersion.append(dispersion[j,ii])
-                newflux.append(flux[j,ii])
-                newivar.append(ivar[j,ii])
-            dispersion = newdispersion
-            flux = newflux
-            ivar = newivar
+        finite = np.isfinite(dispersion)
+        if not finite.all():
+            dispersion = [dispersion[j, finite[j]] for j in range(num_orders)]
+            flux = [flux[j, finite[j]] for j in range(num_orders)]
+            ivar = [ivar[j, finite[j]] for j in range(num_orders)]
 
         return (dispersion, flux, ivar, metadata)
 
@@ -520,81 +810,76 @@ class Spectrum1D(object):
             The path of the FITS filename to read.
         """
 
-        image = fits.open(path)
+        with fits.open(path, memmap=True, lazy_load_hdus=True) as image:
 
-        # Merge headers into a metadata dictionary.
-        metadata = OrderedDict()
-        for key, value in image[0].header.items():
-            if key in metadata:
-                metadata[key] += value
-            else:
-                metadata[key] = value
-        metadata["smh_read_path"] = path
+            # Merge headers into a metadata dictionary.
+            metadata = _header_to_metadata(image[0].header.items())
+            metadata["smh_read_path"] = path
 
-        # Find the first HDU with data in it.
-        for hdu_index, hdu in enumerate(image):
-            if hdu.data is not None: break
+            # Find the first HDU with data in it.
+            for hdu_index, hdu in enumerate(image):
+                if hdu.data is not None: break
 
-        ctype1 = image[0].header.get("CTYPE1", None)
+            ctype1 = image[0].header.get("CTYPE1", None)
 
-        if len(image) == 2 and hdu_index == 1:
+            if len(image) == 2 and hdu_index == 1:
 
-            dispersion_keys = ("dispersion", "disp", "WAVELENGTH[COORD]")
-            for key in dispersion_keys:
-                try:
-                    dispersion = image[hdu_index].data[key]
+                dispersion_keys = ("dispersion", "disp", "WAVELENGTH[COORD]")
+                for key in dispersion_keys:
+                    try:
+                        dispersion = image[hdu_index].data[key]
 
-                except KeyError:
-                    continue
+                    except KeyError:
+                        continue
 
-                else:
-                    break
+                    else:
+                        break
 
-            else:
-                raise KeyError("could not find any dispersion key: {}".format(
-                    ", ".join(dispersion_keys)))
+                else:
+                    raise KeyError("could not find any dispersion key: {}".format(
+                        ", ".join(dispersion_keys)))
 
-            flux_keys = ("flux", "SPECTRUM[FLUX]")
-            for key in flux_keys:
-                try:
-                    flux = image[hdu_index].data[key]
-                except KeyError:
-                    continue
+                flux_keys = ("flux", "SPECTRUM[FLUX]")
+                for key in flux_keys:
+                    try:
+                        flux = image[hdu_index].data[key]
+                    except KeyError:
+                        continue
+                    else:
+                        break
                 else:
-                    break
-            else:
-                raise KeyError("could not find any flux key: {}".format(
-                    ", ".join(flux_keys)))
+                    raise KeyError("could not find any flux key: {}".format(
+                        ", ".join(flux_keys)))
 
-            # Try ivar, then error, then variance.
-            try:
-                ivar = image[hdu_index].data["ivar"]
-            except KeyError:
+                # Try ivar, then error, then variance.
                 try:
-                    errs = image[hdu_index].data["SPECTRUM[SIGMA]"]
-                    ivar = 1.0/errs**2.
+                    ivar = image[hdu_index].data["ivar"]
                 except KeyError:
-                    variance = image[hdu_index].data["variance"]
-                    ivar = 1.0/variance
-
-        else:
-            # Build a simple linear dispersion map from the headers.
-            # See http://iraf.net/irafdocs/specwcs.php
-            crval = image[0].header["CRVAL1"]
-            naxis = image[0].header["NAXIS1"]
-            crpix = image[0].header.get("CRPIX1", 1)
-            cdelt = image[0].header["CDELT1"]
-            ltv = image[0].header.get("LTV1", 0)
-
-            # + 1 presumably because fits is 1-indexed instead of 0-indexed
-            dispersion = \
-                crval + (np.arange(naxis) + 1 - crpix) * cdelt - ltv * cdelt
+                    try:
+                        errs = image[hdu_index].data["SPECTRUM[SIGMA]"]
+                        ivar = _noise_to_ivar(errs)
+                    except KeyError:
+                        variance = image[hdu_index].data["variance"]
+                        ivar = 1.0/variance
 
-            flux = image[0].data
-            if len(image) == 1:
-                ivar = np.ones_like(flux)*1e+5 # HACK S/N ~300 just for training/verification purposes
             else:
-                ivar = image[1].data
+                # Build a simple linear dispersion map from the headers.
+                # See http://iraf.net/irafdocs/specwcs.php
+                crval = image[0].header["CRVAL1"]
+                naxis = image[0].header["NAXIS1"]
+                crpix = image[0].header.get("CRPIX1", 1)
+                cdelt = image[0].header["CDELT1"]
+                ltv = image[0].header.get("LTV1", 0)
+
+                # + 1 presumably because fits is 1-indexed instead of 0-indexed
+                dispersion = \
+                    crval + (np.arange(naxis) + 1 - crpix) * cdelt - ltv * cdelt
+
+                flux = image[0].data
+                if len(image) == 1:
+                    ivar = np.ones_like(flux)*1e+5 # HACK S/N ~300 just for training/verification purposes
+                else:
+                    ivar = image[1].data
 
         dispersion = np.atleast_2d(dispersion)
         flux = np.atleast_2d(flux)
@@ -620,18 +905,18 @@ class Spectrum1D(object):
 
         if len(kwds["usecols"])==3:
             try:
-                dispersion, flux, ivar = np.loadtxt(path, **kwds)
+                dispersion, flux, ivar = _loadtxt(path, **kwds)
             except:
                 # Try by ignoring the first row.
                 kwds.setdefault("skiprows", 1)
-                dispersion, flux, ivar = np.loadtxt(path, **kwds)
+                dispersion, flux, ivar = _loadtxt(path, **kwds)
         elif len(kwds["usecols"])==2:
             try:
-                dispersion, flux = np.loadtxt(path, **kwds)
+                dispersion, flux = _loadtxt(path, **kwds)
             except:
                 # Try by ignoring the first row.
                 kwds.setdefault("skiprows", 1)
-                dispersion, flux = np.loadtxt(path, **kwds)
+                dispersion, flux = _loadtxt(path, **kwds)
             
             ivar = np.ones_like(flux)*1e+5 # HACK S/N ~300 just for training/verification purposes
 
@@ -667,24 +952,34 @@ class Spectrum1D(object):
         if not filename.endswith('fits'):
             if header is not None:
                 print("Writing text, cannot include header!")
-            a = np.array([self.dispersion, self.flux, self.ivar]).T
             if self.ivar.min() < 1e-4 and self.ivar.min() > 0.000000000001:
                 fmt = "%.12f"
             else:
                 fmt = "%.4f"
-            np.savetxt(filename, a, fmt=fmt.encode('ascii'))
+            if pd is not None:
+                # pandas formats and writes the rows in C, in large chunks
+                pd.DataFrame({"dispersion": self.dispersion, "flux": self.flux,
+                    "ivar": self.ivar}).to_csv(filename, sep=" ",
+                    header=False, index=False, float_format=fmt, na_rep="nan")
+            else:
+                a = np.array([self.dispersion, self.flux, self.ivar]).T
+                np.savetxt(filename, a, fmt=fmt)
             return
         
         else:
 
             crpix1, crval1 = 1, self.dispersion.min()
-            cdelt1 = np.mean(np.diff(self.dispersion))
             naxis1 = len(self.dispersion)
-            
-            linear_dispersion = crval1 + (np.arange(naxis1) + 1 - crpix1) * cdelt1
+            # (the mean of the pixel steps, without differencing every pixel)
+            cdelt1 = (self.dispersion[-1] - self.dispersion[0]) / (naxis1 - 1)
 
             ## Check for linear dispersion map
-            maxdiff = np.max(np.abs(linear_dispersion - self.dispersion))
+            # (built up in a single buffer, since it's only needed for maxdiff)
+            residual = np.arange(naxis1, dtype=float)
+            residual *= cdelt1
+            residual += crval1
+            residual -= self.dispersion
+            maxdiff = np.max(np.abs(residual, out=residual))
             if maxdiff > 1e-3:
                 ## TODO Come up with something better...
                 ## Frustratingly, it seems like there's no easy way to make an IRAF splot-compatible
@@ -731,8 +1026,9 @@ class Spectrum1D(object):
 
             else:
                 # We have a linear dispersion!
-                hdu = fits.PrimaryHDU(np.array(self.flux))
-                hdu2 = fits.ImageHDU(np.array(self.ivar))
+                # (no copies unless the arrays are not contiguous)
+                hdu = fits.PrimaryHDU(np.ascontiguousarray(self.flux))
+                hdu2 = fits.ImageHDU(np.ascontiguousarray(self.ivar))
     
                 #headers = self.headers.copy()
                 #headers = {}
@@ -750,7 +1046,7 @@ class Spectrum1D(object):
                     'CDELT1': cdelt1
                 })
                 
-                for key, value in iteritems(headers):
+                for key, value in headers.items():
                     try:
                         hdu.header[key] = value
                     except ValueError:
@@ -777,16 +1073,19 @@ class Spectrum1D(object):
         if (v is None and z is None) or (v is not None and z is not None):
             raise ValueError("either v or z must be given, but not both")
 
-        if reinterpolate:
-            olddisp = self._dispersion.copy()
+        if z is None:
+            z = v * _inv_c
 
-        z = z or v/299792458e-3
-        self._dispersion *= 1 + z
-        
         if reinterpolate:
-            newflux = np.interp(olddisp, self._dispersion, self._flux)
-            self._dispersion = olddisp
-            self._flux = newflux
+            # Sampling the redshifted spectrum on the original dispersion is
+            # the same as sampling the original at dispersion/(1 + z), so the
+            # dispersion never needs to be copied and shifted. (np.interp
+            # walks sorted sample points in linear time, which is faster than
+            # a pixel shift with ndimage.shift even on log-uniform grids.)
+            self._flux = np.interp(
+                self._dispersion / (1 + z), self._dispersion, self._flux)
+        else:
+            self._dispersion = self._dispersion * (1 + z)
         return True
 
 
@@ -832,14 +1131,32 @@ class Spectrum1D(object):
         # smoothing value
         
         true_profile_sigma = profile_sigma / np.median(np.diff(self.dispersion))
-        smoothed_flux = ndimage.gaussian_filter1d(self.flux, true_profile_sigma, **kwargs)
+        if set(kwargs).issubset(("truncate", "mode", "cval")):
+            # Same as ndimage.gaussian_filter1d, but reusing the kernel
+            kernel = _gaussian_kernel(
+                float(true_profile_sigma), kwargs.pop("truncate", 4.0))
+            smoothed_flux = ndimage.convolve1d(self.flux, kernel, **kwargs)
+        else:
+            smoothed_flux = ndimage.gaussian_filter1d(self.flux, true_profile_sigma, **kwargs)
         
         # TODO modify ivar based on smoothing?
         return self.__class__(self.dispersion, smoothed_flux, self.ivar.copy(), metadata=self.metadata.copy())
         
     
-    def linterpolate(self, new_dispersion, fill_value=0.):
-        """ Straight up linear interpolation of flux and ivar onto a new dispersion """
+    def linterpolate(self, new_dispersion, fill_value=0., flux_conserving=False):
+        """
+        Straight up linear interpolation of flux and ivar onto a new dispersion
+
+        If flux_conserving is True, the flux is instead rebinned conserving
+        flux (as in SpectRes; Carnall 2017), which is more accurate when the
+        new dispersion is coarser, and the ivar is propagated accordingly.
+        """
+        # The new spectrum owns its dispersion (callers reuse one grid for many spectra)
+        new_dispersion = np.array(new_dispersion)
+        if flux_conserving:
+            new_flux, new_ivar = _rebin_flux_conserving(new_dispersion,
+                self.dispersion, self.flux, self.ivar, fill_value)
+            return self.__class__(new_dispersion, new_flux, new_ivar, metadata=self.metadata.copy())
         new_flux = np.interp(new_dispersion, self.dispersion, self.flux, left=fill_value, right=fill_value)
         new_ivar = np.interp(new_dispersion, self.dispersion, self.ivar, left=fill_value, right=fill_value)
         return self.__class__(new_dispersion, new_flux, new_ivar, metadata=self.metadata.copy())
@@ -865,7 +1182,6 @@ class Spectrum1D(object):
 
         (This function from Heather Jacobson)
         TODO: the window parameter could be the window itself if an array instead of a string
-        NOTE: length(output) != length(input), to correct this: return y[(window_len/2-1):-(window_len/2)] instead of just y.
         """
 
         if self.flux.size < window_len:
@@ -874,23 +1190,23 @@ class Spectrum1D(object):
         if window_len<3:
             return self
 
-        available = ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']
-        if window not in available:
-            raise ValueError("window is one of {}".format(", ".join(available)))
+        windows = {
+            'flat': lambda n: np.ones(n, 'd'), #moving average
+            'hanning': np.hanning,
+            'hamming': np.hamming,
+            'bartlett': np.bartlett,
+            'blackman': np.blackman
+        }
+        if window not in windows:
+            raise ValueError("window is one of {}".format(", ".join(windows)))
 
+        w = windows[window](window_len)
 
-        s = np.r_[self.flux[window_len-1:0:-1], self.flux, self.flux[-1:-window_len:-1]]
-        
-        if window == 'flat': #moving average
-            w = np.ones(window_len, 'd')
+        # Convolve with the signal reflected (without repeating the end
+        # points) at both ends, centred so the output matches the input.
+        smoothed_flux = ndimage.convolve1d(self.flux, w/w.sum(), mode='mirror')
 
-        else:
-            w = eval('np.' + window + '(window_len)', {'__builtins__': None})
-
-        smoothed_flux = np.convolve(w/w.sum(), s,mode='valid')
-        smoothed_flux = smoothed_flux[(window_len/2-1):-(window_len/2)]
-
-        return self.__class__(self.disp, smoothed_flux, headers=self.headers)
+        return self.__class__(self.dispersion, smoothed_flux, self.ivar.copy(), metadata=self.metadata.copy())
     
 
 
@@ -906,7 +1222,45 @@ class Spectrum1D(object):
         cont = np.poly1d(coeff)(dispersion)
         if getsnr: return np.median(cont)/rms
         if getcont: return cont
-        return self.__class__(dispersion, flux/cont, cont*cont*self.ivar, self.metadata)
+        # flux is already a copy, so normalise it in place.
+        with np.errstate(divide="ignore", invalid="ignore"):
+            np.divide(flux, cont, out=flux)
+        ivar = np.multiply(cont, cont)
+        ivar *= self.ivar
+        return self.__class__(dispersion, flux, ivar, self.metadata)
+
+    def _continuum_mask(self, dispersion, exclude=None,
+        finite_positive_flux=None):
+        """
+        Return a boolean mask of the pixels that can be used to fit the
+        continuum: finite, positive fluxes outside of any `exclude` regions.
+        The finite and positive flux mask can be given if already known.
+        """
+        if finite_positive_flux is None:
+            finite_positive_flux = np.isfinite(self.flux) & (self.flux > 0)
+        mask = finite_positive_flux & np.isfinite(self.ivar)
+        if exclude is not None and len(exclude) > 0:
+            mask &= ~regions_to_mask(dispersion, exclude, inclusive="left")
+        return mask
+
+    def _continuum_setup(self, dispersion, knot_spacing, exclude=None,
+        finite_positive_flux=None):
+        """
+        Return the continuum mask, its indices and the spline knots shared by
+        `fit_continuum` and `get_knots`.
+        """
+        continuum_mask = self._continuum_mask(dispersion, exclude,
+            finite_positive_flux)
+        continuum_indices = np.flatnonzero(continuum_mask)
+
+        if knot_spacing is None or knot_spacing == 0 \
+        or continuum_indices.size == 0:
+            knots = []
+        else:
+            knots = _continuum_knots(dispersion, abs(knot_spacing),
+                dispersion[continuum_indices[0]],
+                dispersion[continuum_indices[-1]])
+        return (continuum_mask, continuum_indices, knots)
 
     def fit_continuum(self, knot_spacing=200, low_sigma_clip=1.0, \
         high_sigma_clip=0.2, max_iterations=3, order=3, exclude=None, \
@@ -958,13 +1312,10 @@ class Spectrum1D(object):
 
         dispersion = self.dispersion.copy()
 
-        exclusions = []
-        continuum_indices = range(len(self.flux))
-
         # Snip left and right
-        finite_positive_flux = np.isfinite(self.flux) * self.flux > 0
+        finite_positive_flux = np.isfinite(self.flux) & (self.flux > 0)
 
-        if np.sum(finite_positive_flux) == 0:
+        if not finite_positive_flux.any():
             # No valid continuum points, return nans
             no_continuum = np.nan * np.ones_like(dispersion)
             failed_spectrum = self.__class__(dispersion=dispersion,
@@ -975,49 +1326,18 @@ class Spectrum1D(object):
             return failed_spectrum
 
         function = str(function).lower()
-        left = np.where(finite_positive_flux)[0][0]
-        right = np.where(finite_positive_flux)[0][-1]
+        left = np.argmax(finite_positive_flux)
+        right = finite_positive_flux.size - 1 \
+              - np.argmax(finite_positive_flux[::-1])
+
+        # Exclude regions, non-finite values and zero or negative fluxes.
+        continuum_mask, continuum_indices, knots = self._continuum_setup(
+            dispersion, knot_spacing, exclude, finite_positive_flux)
 
-        # See if there are any regions we need to exclude
-        if exclude is not None and len(exclude) > 0:
-            exclude_indices = []
-            
-            if isinstance(exclude[0], float) and len(exclude) == 2:
-                # Only two floats given, so we only have one region to exclude
-                exclude_indices.extend(range(*np.searchsorted(dispersion, exclude)))
-                
-            else:
-                # Multiple regions provided
-                for exclude_region in exclude:
-                    exclude_indices.extend(
-                        range(*np.searchsorted(dispersion, exclude_region)))
-        
-            continuum_indices = np.sort(list(set(continuum_indices).difference(
-                np.sort(exclude_indices))))
-            
         # See if there are any regions we should always include
+        include_mask = None
         if include is not None and len(include) > 0:
-            include_indices = []
-            
-            if isinstance(include[0], float) and len(include) == 2:
-                # Only two floats given, so we can only have one region to include
-                include_indices.extend(range(*np.searchsorted(dispersion, include)))
-                
-            else:
-                # Multiple regions provided
-                for include_region in include:
-                    include_indices.extend(range(*np.searchsorted(
-                        dispersion, include_region)))
-        
-        # We should exclude non-finite values from the fit.
-        non_finite_indices = np.where(~np.isfinite(self.flux * self.ivar))[0]
-        continuum_indices = np.sort(list(set(continuum_indices).difference(
-            non_finite_indices)))
-
-        # We should also exclude zero or negative flux points from the fit
-        zero_flux_indices = np.where(0 >= self.flux)[0]
-        continuum_indices = np.sort(list(set(continuum_indices).difference(
-            zero_flux_indices)))
+            include_mask = regions_to_mask(dispersion, include, inclusive="left")
 
         # Fix from Erika Holmbeck
         if order > continuum_indices.size:
@@ -1033,24 +1353,7 @@ class Spectrum1D(object):
 
         original_continuum_indices = continuum_indices.copy()
 
-        if knot_spacing is None or knot_spacing == 0:
-            knots = []
-
-        else:
-            knot_spacing = abs(knot_spacing)
-            
-            end_spacing = ((dispersion[-1] - dispersion[0]) % knot_spacing) /2.
-            if knot_spacing/2. > end_spacing: end_spacing += knot_spacing/2.
-                
-            knots = np.arange(dispersion[0] + end_spacing, 
-                dispersion[-1] - end_spacing + knot_spacing, 
-                knot_spacing)
-
-            if len(knots) > 0 and knots[-1] > dispersion[continuum_indices][-1]:
-                knots = knots[:knots.searchsorted(dispersion[continuum_indices][-1])]
-                
-            if len(knots) > 0 and knots[0] < dispersion[continuum_indices][0]:
-                knots = knots[knots.searchsorted(dispersion[continuum_indices][0]):]
+        finite_flux = np.isfinite(self.flux)
 
         # TODO: Use inverse variance array when fitting polynomial/spline.
         for iteration in range(max_iterations):
@@ -1077,16 +1380,19 @@ class Spectrum1D(object):
             # We need to add in additional points at the last minute here
             if additional_points is not None and len(additional_points) > 0:
 
-                for point, flux, weight in additional_points:
+                # Sort the points (later ones first, if equal) so that all
+                # can be inserted at once, as if inserted one at a time.
+                points = np.array(additional_points, dtype=float)[::-1]
+                points = points[np.argsort(points[:, 0], kind="stable")]
 
-                    # Get the index of the fit
-                    insert_index = int(np.searchsorted(splrep_disp, point))
-                    
-                    # Insert the values
-                    splrep_disp = np.insert(splrep_disp, insert_index, point)
-                    splrep_flux = np.insert(splrep_flux, insert_index, flux)
-                    splrep_weights = np.insert(splrep_weights, insert_index, 
-                        median_weight * weight)
+                # Get the index of the fit
+                insert_indices = np.searchsorted(splrep_disp, points[:, 0])
+
+                # Insert the values
+                splrep_disp = np.insert(splrep_disp, insert_indices, points[:, 0])
+                splrep_flux = np.insert(splrep_flux, insert_indices, points[:, 1])
+                splrep_weights = np.insert(splrep_weights, insert_indices,
+                    median_weight * points[:, 2])
 
             if function == 'spline':
                 if order > 5:
@@ -1107,43 +1413,33 @@ class Spectrum1D(object):
 
             elif function in ("poly", "polynomial"):
 
-                coeffs = polyfit(splrep_disp, splrep_flux, order)
-
-                popt, pcov = op.curve_fit(lambda x, *c: np.polyval(c, x), 
-                    splrep_disp, splrep_flux, coeffs, 
-                    # Note: Erika changed sigma to splrep_weights, not changing yet
-                    sigma=self.ivar[continuum_indices], absolute_sigma=False)
-                continuum = np.polyval(popt, dispersion)
+                # The model is linear in the coefficients, so the weighted
+                # least-squares solution is exact; no need to iterate with
+                # op.curve_fit. Using sigma = ivar there is the same as
+                # w = 1/ivar here.
+                # Note: Erika changed sigma to splrep_weights, not changing yet
+                coeffs = np.polyfit(splrep_disp, splrep_flux, order,
+                                    w=1.0/splrep_weights)
+                continuum = np.polyval(coeffs, dispersion)
 
             elif function in ("leg", "legendre"):
-                
+
                 coeffs = np.polynomial.legendre.legfit(splrep_disp, splrep_flux, order,
-                                                       w=splrep_weights)
-                
-                popt, pcov = op.curve_fit(lambda x, *c: np.polynomial.legendre.legval(x, c), 
-                    splrep_disp, splrep_flux, coeffs, 
-                    # Note: Erika changed sigma to splrep_weights, not changing yet
-                    sigma=self.ivar[continuum_indices], absolute_sigma=False)
-                continuum = np.polynomial.legendre.legval(dispersion, popt)
+                                                       w=1.0/splrep_weights)
+                continuum = np.polynomial.legendre.legval(dispersion, coeffs)
 
 
             elif function in ("cheb", "chebyshev"):
-                
+
                 coeffs = np.polynomial.chebyshev.chebfit(splrep_disp, splrep_flux, order,
-                                                         w=splrep_weights)
-                
-                popt, pcov = op.curve_fit(lambda x, *c: np.polynomial.chebyshev.chebval(x, c), 
-                    splrep_disp, splrep_flux, coeffs, 
-                    # Note: Erika changed sigma to splrep_weights, not changing yet
-                    sigma=self.ivar[continuum_indices], absolute_sigma=False)
-                continuum = np.polynomial.chebyshev.chebval(dispersion, popt)
+                                                         w=1.0/splrep_weights)
+                continuum = np.polynomial.chebyshev.chebval(dispersion, coeffs)
 
 
             elif function in ("polysinc"):
                 # sinc^2(x) * polynomial
                 # sinc has 3 parameters: norm, center, shape
                 # polynomial has <order> parameters
-                # This is really slow because of maxfev
 
                 # Initialize sinc
                 p0 = [np.percentile(splrep_flux, 95), np.median(splrep_disp),
@@ -1151,15 +1447,45 @@ class Spectrum1D(object):
                 p0, p0cov = op.curve_fit(lambda x, *p: p[0]*np.sinc((x-p[1])/p[2])**2,
                                          splrep_disp, splrep_flux, p0)
                 
-                # Fit polysinc (this is slow but seems to work)
-                _func = lambda x, *p: p[0]*np.sinc((x-p[1])/p[2])**2 * np.polyval(p[3:], x)
-                p0 = [p0[0], p0[1], p0[2]] + [0. for O in range(order)]
-                popt, pcov = op.curve_fit(_func, 
-                    splrep_disp, splrep_flux, p0, 
+                # Fit polysinc with an analytic Jacobian. The norm is folded
+                # into the polynomial (it is degenerate with it), the width is
+                # fit as log(width), and the polynomial is evaluated from a
+                # basis in scaled wavelength that is computed once.
+                mid = 0.5 * (splrep_disp[0] + splrep_disp[-1])
+                half = 0.5 * np.ptp(splrep_disp) or 1.
+                V = np.vander((splrep_disp - mid)/half, order)
+
+                def _sinc(x, center, log_width):
+                    u = (x - center) * np.exp(-log_width)
+                    sinc = np.sinc(u)
+                    # d(sinc)/du = (cos(pi u) - sinc(u))/u, which is 0 at u = 0
+                    with np.errstate(divide="ignore", invalid="ignore"):
+                        dsinc = np.where(u == 0, 0., (np.cos(np.pi * u) - sinc)/u)
+                    return u, sinc, dsinc
+
+                def _model(x, *p):
+                    u, sinc, _ = _sinc(x, p[0], p[1])
+                    return sinc**2 * (V @ np.array(p[2:]))
+
+                def _jac(x, *p):
+                    u, sinc, dsinc = _sinc(x, p[0], p[1])
+                    d_du = 2 * (V @ np.array(p[2:])) * sinc * dsinc
+                    return np.column_stack([-d_du * np.exp(-p[1]), -d_du * u,
+                        (sinc**2)[:, None] * V])
+
+                # Start from the sinc fit (a constant polynomial)
+                coeffs0 = np.zeros(order)
+                if order > 0: coeffs0[-1] = p0[0]
+                p0 = [p0[1], np.log(np.abs(p0[2]))] + list(coeffs0)
+                popt, pcov = op.curve_fit(_model,
+                    splrep_disp, splrep_flux, p0, jac=_jac,
+                    method="trf", x_scale="jac",
                     # Note: Erika changed sigma to splrep_weights, not changing yet
-                    sigma=self.ivar[continuum_indices], absolute_sigma=False, maxfev=100000)
-                
-                continuum = _func(dispersion, *popt)
+                    sigma=self.ivar[continuum_indices], absolute_sigma=False,
+                    max_nfev=100000)
+
+                u, sinc, _ = _sinc(dispersion, popt[0], popt[1])
+                continuum = sinc**2 * np.polyval(popt[2:], (dispersion - mid)/half)
 
             elif function in ("trig","sincos"):
                 # Casey+2016
@@ -1171,31 +1497,25 @@ class Spectrum1D(object):
                 raise ValueError("Unknown function type: only spline or poly "\
                     "available ({} given)".format(function))
             
+            # Clip in units of the standard deviation, scaling the clipping
+            # levels rather than the differences
             difference = continuum - self.flux
-            sigma_difference = difference \
-                / np.std(difference[np.isfinite(self.flux)])
+            sigma = np.std(difference, where=finite_flux)
 
             # Clipping
-            upper_exclude = np.where(sigma_difference > high_sigma_clip)[0]
-            lower_exclude = np.where(sigma_difference < -low_sigma_clip)[0]
-            
-            exclude_indices = list(upper_exclude)
-            exclude_indices.extend(lower_exclude)
-            exclude_indices = np.array(exclude_indices)
+            clipped = difference > high_sigma_clip * sigma
+            clipped |= difference < -low_sigma_clip * sigma
             
-            if len(exclude_indices) == 0: break
-            
-            exclusions.extend(exclude_indices)
+            if not clipped.any(): break
             
             # Before excluding anything, we must check to see if there are regions
             # which we should never exclude
-            if include is not None:
-                exclude_indices \
-                    = set(exclude_indices).difference(include_indices)
+            if include_mask is not None:
+                clipped &= ~include_mask
             
             # Remove regions that have been excluded
-            continuum_indices = np.sort(list(set(continuum_indices).difference(
-                exclude_indices)))
+            continuum_mask &= ~clipped
+            continuum_indices = np.flatnonzero(continuum_mask)
         
         # Snip the edges based on exclude regions
         if exclude is not None and len(exclude) > 0:
@@ -1209,10 +1529,17 @@ class Spectrum1D(object):
         # Apply flux scaling
         continuum *= scale
 
+        # Only normalise the pixels that are kept.
+        cont_sl = continuum[left:right]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            norm_flux = np.divide(self.flux[left:right], cont_sl)
+        norm_ivar = np.multiply(cont_sl, cont_sl)
+        norm_ivar *= self.ivar[left:right]
+
         normalized_spectrum = self.__class__(
             dispersion=dispersion[left:right],
-            flux=(self.flux/continuum)[left:right], 
-            ivar=(continuum * self.ivar * continuum)[left:right],
+            flux=norm_flux,
+            ivar=norm_ivar,
             metadata=self.metadata)
 
         # Return a normalized spectrum.
@@ -1232,68 +1559,171 @@ class Spectrum1D(object):
         """
         This is a hack to get the knots used in the fit_continuum spline
         """
-        dispersion = self.dispersion.copy()
+        return self._continuum_setup(self.dispersion, knot_spacing, exclude)[2]
+    
+    def add_noise(self, seed=None):
+        if seed is not None:
+            np.random.seed(seed)
+        # Scale the draws in place (same random stream as before for a seed)
+        noisy_flux = np.random.randn(len(self.flux))
+        noisy_flux /= np.sqrt(self.ivar)
+        noisy_flux += self.flux
+        return self.__class__(self.dispersion, noisy_flux, self.ivar, self.metadata)
+
 
-        continuum_indices = range(len(self.flux))
-        
-        # See if there are any regions we need to exclude
-        if exclude is not None and len(exclude) > 0:
-            exclude_indices = []
-            
-            if isinstance(exclude[0], float) and len(exclude) == 2:
-                # Only two floats given, so we only have one region to exclude
-                exclude_indices.extend(range(*np.searchsorted(dispersion, exclude)))
-                
-            else:
-                # Multiple regions provided
-                for exclude_region in exclude:
-                    exclude_indices.extend(
-                        range(*np.searchsorted(dispersion, exclude_region)))
-        
-            continuum_indices = np.sort(list(set(continuum_indices).difference(
-                np.sort(exclude_indices))))
 
-        # We should exclude non-finite values from the fit.
-        non_finite_indices = np.where(~np.isfinite(self.flux * self.ivar))[0]
-        continuum_indices = np.sort(list(set(continuum_indices).difference(
-            non_finite_indices)))
+class SpectrumOrders(list):
+    """
+    A list of Spectrum1D orders that all have the same number of pixels,
+    backed by (num_orders, num_pixels) `dispersion`, `flux` and `ivar` arrays.
+
+    The arrays of each order are row views of these arrays, so operations
+    over all orders can read the 2D arrays at once. It can be used
+    anywhere a list of orders is. The 2D arrays are read-only, and if the
+    list or its orders have changed since creation they are re-stacked from
+    the current orders.
+    """
 
-        # We should also exclude zero or negative flux points from the fit
-        zero_flux_indices = np.where(0 >= self.flux)[0]
-        continuum_indices = np.sort(list(set(continuum_indices).difference(
-            zero_flux_indices)))
+    def __init__(self, dispersion, flux, ivar, metadata=None, klass=None):
+        """
+        :param dispersion:
+            A (num_orders, num_pixels) array of dispersion values.
 
+        :param flux:
+            A (num_orders, num_pixels) array of flux values.
 
-        if knot_spacing is None or knot_spacing == 0 or continuum_indices == []:
-            knots = []
+        :param ivar:
+            A (num_orders, num_pixels) array of inverse variances.
+
+        :param metadata: [optional]
+            A metadata dictionary shared by all orders.
+
+        :param klass: [optional]
+            The class of the orders (default: Spectrum1D).
+        """
+
+        klass = klass or Spectrum1D
+        dispersion, flux, ivar = map(np.asarray, (dispersion, flux, ivar))
+
+        # Orders must run blue to red, so flip them here rather than per order
+        # (which would make the orders out of step with the 2D arrays).
+        reverse = dispersion[:, 0] > dispersion[:, -1]
+        if np.all(reverse):
+            dispersion, flux, ivar = dispersion[:, ::-1], flux[:, ::-1], ivar[:, ::-1]
+        elif np.any(reverse):
+            dispersion, flux, ivar = [np.where(reverse[:, np.newaxis], _[:, ::-1], _) \
+                for _ in (dispersion, flux, ivar)]
+
+        super(SpectrumOrders, self).__init__(
+            [klass(dispersion=d, flux=f, ivar=i, metadata=metadata) \
+                for d, f, i in zip(dispersion, flux, ivar)])
+
+        # Orders without any inverse variance get a placeholder on creation.
+        # Write those into a copy: the given ivar may belong to the caller.
+        placeholders = [j for j, order in enumerate(self) \
+            if not np.may_share_memory(order.ivar, ivar)]
+        if placeholders:
+            ivar = ivar.copy()
+            for j in placeholders:
+                ivar[j] = self[j].ivar
+            for j, order in enumerate(self):
+                order._ivar = ivar[j]
+
+        self._arrays = {"dispersion": dispersion, "flux": flux, "ivar": ivar}
+        self._rows = [(order._dispersion, order._flux, order._ivar) \
+            for order in self]
+
+
+    def _stacked(self, name, index):
+        """
+        Return a read-only (num_orders, num_pixels) array of the `name` arrays
+        of all orders: a view of the backing array while every order is still
+        its original row, otherwise a new stack of the current orders.
+        """
+        attr = "_" + name
+        if len(self) == len(self._rows) and all(getattr(order, attr) is rows[index] \
+                for order, rows in zip(self, self._rows)):
+            array = self._arrays[name].view()
         else:
-            knot_spacing = abs(knot_spacing)
-            
-            end_spacing = ((dispersion[-1] - dispersion[0]) % knot_spacing) /2.
-            if knot_spacing/2. > end_spacing: end_spacing += knot_spacing/2.
-                
-            knots = np.arange(dispersion[0] + end_spacing, 
-                dispersion[-1] - end_spacing + knot_spacing, 
-                knot_spacing)
+            array = np.vstack([getattr(order, name) for order in self])
+        array.flags.writeable = False
+        return array
 
-            try:
-                if len(knots) > 0 and knots[-1] > dispersion[continuum_indices][-1]:
-                    knots = knots[:knots.searchsorted(dispersion[continuum_indices][-1])]
-                
-                if len(knots) > 0 and knots[0] < dispersion[continuum_indices][0]:
-                    knots = knots[knots.searchsorted(dispersion[continuum_indices][0]):]
-            except IndexError:
-                print("Spectrum error: continuum indices:",continuum_indices)
-                knots = []
-        return knots
-    
-    def add_noise(self, seed=None):
-        if seed is not None:
-            np.random.seed(seed)
-        noise = np.sqrt(1./self.ivar) * np.random.randn(len(self.flux))
-        return self.__class__(self.dispersion, self.flux + noise, self.ivar, self.metadata)
+    @property
+    def dispersion(self):
+        """ The dispersion of all orders, as a (num_orders, num_pixels) array. """
+        return self._stacked("dispersion", 0)
+
+    @property
+    def flux(self):
+        """ The flux of all orders, as a (num_orders, num_pixels) array. """
+        return self._stacked("flux", 1)
+
+    @property
+    def ivar(self):
+        """ The inverse variance of all orders, as a (num_orders, num_pixels) array. """
+        return self._stacked("ivar", 2)
+
+
+    @staticmethod
+    def can_hold(dispersion, flux, ivar):
+        """
+        Return whether the arrays are all (num_orders, num_pixels) arrays of the
+        same shape, with more than one order.
+        """
+        arrays = (dispersion, flux, ivar)
+        return all(isinstance(_, np.ndarray) and _.ndim == 2 for _ in arrays) \
+            and dispersion.shape == flux.shape == ivar.shape \
+            and dispersion.shape[0] > 1 and dispersion.shape[1] > 1
+
+
+
+@njit(cache=True, fastmath=True)
+def _chebyshev_sum(x, coefficients):
+    """
+    Evaluate a Chebyshev series with the given coefficients at x (in [-1, 1]),
+    accumulating the sum as the recurrence goes instead of storing each term.
+    """
+    p0 = np.ones_like(x)
+    p1 = x.copy()
+    total = coefficients[0] * p0 + coefficients[1] * p1
+    for i in range(2, len(coefficients)):
+        p2 = 2 * x * p1 - p0
+        total += coefficients[i] * p2
+        p0, p1 = p1, p2
+    return total
+
+
+@njit(cache=True, fastmath=True)
+def _legendre_sum(x, coefficients):
+    """
+    Evaluate a Legendre series with the given coefficients at x (in [-1, 1]),
+    accumulating the sum as the recurrence goes instead of storing each term.
+    """
+    p0 = np.ones_like(x)
+    p1 = x.copy()
+    total = coefficients[0] * p0 + coefficients[1] * p1
+    for i in range(2, len(coefficients)):
+        p2 = ((2*i - 1)*x*p1 - (i - 1)*p0) / i
+        total += coefficients[i] * p2
+        p0, p1 = p1, p2
+    return total
+
+
+@njit(cache=True, fastmath=True)
+def _cubic_spline_sum(s, coefficients, order):
+    """
+    Evaluate an IRAF cubic spline with `order` pieces and `order + 3`
+    coefficients at the (scaled) pixel positions s, in one pass without
+    building the four basis arrays.
+    """
+    j = np.minimum(np.maximum(s.astype(np.int64), 0), order - 1)
+    a = j + 1 - s
+    b = s - j
+    ab = 1 + a*b
+    return coefficients[j] * a**3 + coefficients[j + 1] * (1 + 3*a*ab) \
+         + coefficients[j + 2] * (1 + 3*b*ab) + coefficients[j + 3] * b**3
 
-    
 
 def compute_dispersion(aperture, beam, dispersion_type, dispersion_start,
     mean_dispersion_delta, num_pixels, redshift, aperture_low, aperture_high,
@@ -1399,16 +1829,8 @@ def compute_dispersion(aperture, beam, dispersion_type, dispersion_start,
 
             order = int(order)
             n = np.linspace(-1, 1, Pmax - Pmin + 1)
-            temp = np.zeros((Pmax - Pmin + 1, order), dtype=float)
-            temp[:, 0] = 1
-            temp[:, 1] = n
-            for i in range(2, order):
-                temp[:, i] = 2 * n * temp[:, i-1] - temp[:, i-2]
-            
-            for i in range(0, order):
-                temp[:, i] *= coefficients[i]
-
-            dispersion = temp.sum(axis=1)
+            dispersion = _chebyshev_sum(
+                n, np.array(coefficients[:order], dtype=float))
 
 
         elif function_type == 2:
@@ -1419,37 +1841,20 @@ def compute_dispersion(aperture, beam, dispersion_type, dispersion_start,
 
             Pmean = (Pmax + Pmin)/2
             Pptp = Pmax - Pmin
-            x = (np.arange(num_pixels) + 1 - Pmean)/(Pptp/2)
-            p0 = np.ones(num_pixels)
-            p1 = mean_dispersion_delta
-
-            dispersion = coefficients[0] * p0 + coefficients[1] * p1
-            for i in range(2, int(order)):
-                if function_type == 1:
-                    # Chebyshev
-                    p2 = 2 * x * p1 - p0
-                else:
-                    # Legendre
-                    p2 = ((2*i - 1)*x*p1 - (i - 1)*p0) / i
-
-                dispersion += p2 * coefficients[i]
-                p0, p1 = (p1, p2)
+            x = (np.arange(int(num_pixels)) + 1 - Pmean)/(Pptp/2)
+            dispersion = _legendre_sum(
+                x, np.array(coefficients[:int(order)], dtype=float))
 
         elif function_type == 3:
             # Cubic spline.
             if None in (order, Pmin, Pmax, coefficients):
                 raise TypeError("order, Pmin, Pmax and coefficients required "
                                 "for a cubic spline mapping")
-            s = (np.arange(num_pixels, dtype=float) + 1 - Pmin)/(Pmax - Pmin) \
+            order = int(order)
+            s = (np.arange(int(num_pixels), dtype=float) + 1 - Pmin)/(Pmax - Pmin) \
               * order
-            j = s.astype(int).clip(0, order - 1)
-            a, b = (j + 1 - s, s - j)
-            x = np.array([
-                a**3,
-                1 + 3*a*(1 + a*b),
-                1 + 3*b*(1 + a*b),
-                b**3])
-            dispersion = np.dot(np.array(coefficients), x.T)
+            dispersion = _cubic_spline_sum(
+                s, np.array(coefficients[:order + 3], dtype=float), order)
 
         else:
             raise NotImplementedError("function type not implemented yet")
@@ -1458,11 +1863,88 @@ def compute_dispersion(aperture, beam, dispersion_type, dispersion_start,
         raise ValueError(
             "dispersion type {0} not recognised".format(dispersion_type))
 
-    # Apply redshift correction.
-    dispersion = weight * (dispersion + offset) / (1 + redshift)
+    # Apply redshift correction, in place on the freshly computed array.
+    dispersion = np.asarray(dispersion, dtype=float)
+    np.add(dispersion, offset, out=dispersion)
+    np.multiply(dispersion, weight / (1. + redshift), out=dispersion)
+    return dispersion
+
+
+def _compute_all_dispersions(order_mapping, num_orders, num_pixels):
+    """
+    Compute the dispersion of every order in a multi-spec order mapping.
+
+    Linear and log-linear orders (by far the most common) are evaluated
+    together as one array expression; any other order falls back to
+    `compute_dispersion`. Orders shorter than `num_pixels` are padded with
+    NaNs so that ragged orders can be identified later.
+
+    :param order_mapping:
+        The dispersion mapping parameters of each order, one row per order.
+
+    :param num_orders:
+        The number of orders.
+
+    :param num_pixels:
+        The maximum number of pixels in any order.
+
+    :returns:
+        An array of shape `(num_orders, num_pixels)` with dispersion values.
+    """
+
+    dispersion = np.full((num_orders, num_pixels), np.nan)
+    pixels = np.arange(num_pixels)
+
+    linear = []
+    for j in range(num_orders):
+        mapping = order_mapping[j]
+        if mapping[2] in (0, 1) and mapping[5] == num_pixels:
+            linear.append(j)
+        else:
+            _dispersion = compute_dispersion(*mapping)
+            dispersion[j, 0:len(_dispersion)] = _dispersion
+
+    if linear:
+        # The weight and offset are optional (defaulting to 1 and 0)
+        params = np.ones((len(linear), 11))
+        params[:, 10] = 0.
+        for row, j in zip(params, linear):
+            mapping = order_mapping[j][:11]
+            row[:len(mapping)] = mapping
+        start, delta, redshift = params[:, 3], params[:, 4], params[:, 6]
+        weight, offset = params[:, 9], params[:, 10]
+
+        _dispersion = start[:, None] + pixels * delta[:, None]
+        log = (start == 1)
+        if np.any(log):
+            _dispersion[log] = 10.**_dispersion[log]
+
+        dispersion[linear] = (weight * (_dispersion.T + offset) \
+            / (1 + redshift)).T
+
+    return dispersion
+
+
+@lru_cache(maxsize=32)
+def _cached_dispersion(concatenated_wat, num_orders, num_pixels):
+    order_mapping = _parse_order_mapping(concatenated_wat)
+    dispersion = _compute_all_dispersions(order_mapping, num_orders, num_pixels)
+    dispersion.flags.writeable = False
     return dispersion
 
 
+def _dispersion_from_wat(concatenated_wat, num_orders, num_pixels):
+    """
+    Compute the dispersion of every order from a concatenated WAT2 string.
+
+    The dispersion mapping only depends on the WAT2 keywords and the image
+    size, so repeated reads of the same (or an identically calibrated) file
+    reuse the previously computed dispersion instead of parsing the order
+    mapping again. A copy is returned, so callers are free to modify it.
+    """
+    return _cached_dispersion(concatenated_wat, num_orders, num_pixels).copy()
+
+
 def common_dispersion_map(spectra, full_output=True):
     """
     Produce a common dispersion mapping for (potentially overlapping) spectra
@@ -1485,6 +1967,7 @@ def common_dispersion_map(spectra, full_output=True):
     # Make spectra blue to right.
     spectra = sorted(spectra, key=lambda s: s.dispersion[0])
 
+    # Collect the (views of) dispersion arrays and join them once at the end.
     common = []
     discard_bluest_pixels = None
     for i, blue_spectrum in enumerate(spectra[:-1]):
@@ -1496,28 +1979,35 @@ def common_dispersion_map(spectra, full_output=True):
             
             # Take the "entire" blue spectrum then discard some blue pixels from
             # the red spectrum.
-            common.extend(blue_spectrum.dispersion[discard_bluest_pixels:])
+            common.append(blue_spectrum.dispersion[discard_bluest_pixels:])
             discard_bluest_pixels = red_spectrum.dispersion.searchsorted(
                 blue_spectrum.dispersion[-1])
 
         else:
             # Can just extend the existing map, modulo the first N-ish pixels.
-            common.extend(blue_spectrum.dispersion[discard_bluest_pixels:])
+            common.append(blue_spectrum.dispersion[discard_bluest_pixels:])
             discard_bluest_pixels = None
 
     # For the last spectrum.
     if len(spectra) > 1:
-        common.extend(red_spectrum.dispersion[discard_bluest_pixels:])
+        common.append(red_spectrum.dispersion[discard_bluest_pixels:])
+        common = np.concatenate(common)
 
     else:
         common = spectra[0].dispersion.copy()
 
-    # Ensure that we have sorted, unique values from blue to red.
-    common = np.unique(common)
-
-    assert np.all(np.diff(common) > 0), \
+    # Ensure that we have sorted, unique values from blue to red. The map is
+    # mostly sorted already, and NaNs (which break the map) sort to the end.
+    common.sort(kind="mergesort")
+    assert common.size == 0 or not np.isnan(common[-1]), \
         "Spectra must be contiguous from blue to red"
 
+    if common.size > 1:
+        keep = np.empty(common.size, dtype=bool)
+        keep[0] = True
+        np.greater(common[1:], common[:-1], out=keep[1:])
+        common = common[keep]
+
     if full_output:
         indices = [common.searchsorted(s.dispersion) for s in spectra]
         return (common, indices, spectra)
@@ -1582,121 +2072,291 @@ def stitch_old(spectra, linearize_dispersion = False, min_disp_step = 0.001):
     return Spectrum1D(dispersion, flux, ivar)
     
 
-def common_dispersion_map2(spectra):
+def _region_dispersion_steps(spectra):
+    """
+    Split the dispersion range of the spectra at every spectrum edge, and
+    return the region edges and the smallest dispersion step of the spectra
+    overlapping each region.
+    """
     # Find regions that will have individual dispersions
-    lefts = []; rights = []
-    dwls = []
-    for spectrum in spectra:
-        lefts.append(spectrum.dispersion.min())
-        rights.append(spectrum.dispersion.max())
-        dwls.append(np.median(np.diff(spectrum.dispersion)))
-    points = np.sort(lefts + rights)
-    Nregions = len(points)-1
-    
-    # Create dispersion map
-    # Find orders in each region and use minimum dwl
-    alldisp = []
-    for i in range(Nregions):
-        r_left = points[i]
-        r_right = points[i+1]
-        r_dwl = 99999.
-        #print(i)
-        num_spectra = 0
-        for j, (left, right, dwl) in enumerate(zip(lefts, rights, dwls)):
-            # if order in range, use its dwl
-            if right <= r_left or left >= r_right:
-                pass
-            else:
-                r_dwl = min(r_dwl, dwl)
-                #print("{:3} {:.2f} {:.2f} {:2} {:.2f} {:.2f}".format(i, r_left, r_right, j, left, right))
-                num_spectra += 1
-        #print(i,num_spectra)
-
-        # Use smallest dwl to create linear dispersion
-        # Drop the last point since that will be in the next one
-        alldisp.append(np.arange(r_left, r_right, r_dwl))
+    lefts = np.array([spectrum.dispersion.min() for spectrum in spectra])
+    rights = np.array([spectrum.dispersion.max() for spectrum in spectra])
+    dwls = np.array([np.median(np.diff(spectrum.dispersion))
+        for spectrum in spectra])
+    points = np.sort(np.concatenate([lefts, rights]))
+
+    # Find orders in each region and use minimum dwl. Each spectrum overlaps
+    # a contiguous range of regions (those with points[i] < right and
+    # points[i + 1] > left), so only the overlapping pairs are built.
+    num_regions = points.size - 1
+    first = np.clip(np.searchsorted(points, lefts, side="right") - 1, 0, None)
+    last = np.clip(np.searchsorted(points, rights, side="left"), None, num_regions)
+    counts = np.clip(last - first, 0, None)
+    # (the concatenation of np.arange(first, last) for every spectrum)
+    regions = np.repeat(first - np.cumsum(counts) + counts, counts) \
+            + np.arange(counts.sum())
+    r_dwls = np.full(num_regions, 99999.)
+    np.minimum.at(r_dwls, regions, np.repeat(dwls, counts))
+    return (points, r_dwls)
+
+def common_dispersion_map2(spectra):
+    points, r_dwls = _region_dispersion_steps(spectra)
+
+    # Use smallest dwl to create linear dispersion
+    # Drop the last point since that will be in the next one
+    alldisp = [np.arange(r_left, r_right, r_dwl)
+        for r_left, r_right, r_dwl in zip(points[:-1], points[1:], r_dwls)]
     alldisp = np.concatenate(alldisp)
     return alldisp
 
 def common_dispersion_map3(spectra):
-    # Find regions that will have individual dispersions
-    lefts = []; rights = []
-    dwls = []
-    for spectrum in spectra:
-        lefts.append(spectrum.dispersion.min())
-        rights.append(spectrum.dispersion.max())
-        dwls.append(np.median(np.diff(spectrum.dispersion)))
-    points = np.sort(lefts + rights)
-    Nregions = len(points)-1
-    
-    # Create dispersion map
-    # Find orders in each region and use minimum dwl
-    alldisp = []
-    for i in range(Nregions):
-        r_left = points[i]
-        r_right = points[i+1]
-        r_dwl = 99999.
-        #print(i)
-        num_spectra = 0
-        for j, (left, right, dwl) in enumerate(zip(lefts, rights, dwls)):
-            # if order in range, use its dwl
-            if right <= r_left or left >= r_right:
-                pass
-            else:
-                r_dwl = min(r_dwl, dwl)
-                #print("{:3} {:.2f} {:.2f} {:2} {:.2f} {:.2f}".format(i, r_left, r_right, j, left, right))
-                num_spectra += 1
-        #print(i,num_spectra)
+    points, r_dwls = _region_dispersion_steps(spectra)
 
-        # Use smallest dwl to create linear dispersion
-        # Drop the last point since that will be in the next one
+    # Use smallest dwl to create linear dispersion
+    # Drop the last point since that will be in the next one
+    alldisp = []
+    for r_left, r_right, r_dwl in zip(points[:-1], points[1:], r_dwls):
         disp = np.arange(r_left, r_right, r_dwl)
         if r_right - disp[-1] < r_dwl: disp = disp[:-1]
         alldisp.append(disp)
     alldisp = np.concatenate(alldisp)
     return alldisp
 
-def stitch(spectra, new_dispersion=None, full_output=False):
+def _resample_all(spectra, new_dispersion, buffers=None, dtype=np.float64):
     """
-    Stitch spectra together, some of which may have overlapping dispersion
-    ranges. This is a crude (knowingly incorrect) approximation: we interpolate
-    fluxes without ensuring total conservation.
-    Even worse, we interpolate ivar, which is explicitly not conserved.
-    However the stitching is much better than before.
+    Linearly interpolate the flux and ivar of each spectrum onto a common
+    dispersion, returning (N, new_dispersion.size) arrays that are zero
+    outside of each spectrum.
+
+    Each spectrum usually covers a small part of the common dispersion, so
+    when that is sorted only the overlapping pixels are interpolated. One
+    np.interp per row is faster than interpolating all rows at once from
+    shared indices (as interp1d with axis=1 does), even when the spectra
+    have the same dispersion.
+
+    :param buffers: [optional]
+        A (common_flux, common_ivar) tuple of arrays to write into, instead
+        of allocating new ones.
+
+    :param dtype: [optional]
+        The data type of the arrays, if they are allocated here.
+    """
+    shape = (len(spectra), new_dispersion.size)
+    if buffers is None:
+        common_flux, common_ivar = (np.empty(shape, dtype), np.empty(shape, dtype))
+    else:
+        common_flux, common_ivar = buffers
+        if common_flux.shape != shape or common_ivar.shape != shape:
+            raise ValueError("buffers must have shape {}".format(shape))
 
-    :param spectra:
-        A list of potentially overlapping spectra.
+    is_sorted = np.all(new_dispersion[1:] >= new_dispersion[:-1])
+    for i, spectrum in enumerate(spectra):
+        dispersion = spectrum.dispersion
+        if is_sorted and dispersion.size > 0 and dispersion[0] <= dispersion[-1]:
+            lo = np.searchsorted(new_dispersion, dispersion[0])
+            hi = np.searchsorted(new_dispersion, dispersion[-1], side="right")
+        else:
+            lo, hi = (0, new_dispersion.size)
+
+        # Every pixel is written once: zeros outside, interpolated inside.
+        for common, values in ((common_flux, spectrum.flux),
+                               (common_ivar, spectrum.ivar)):
+            common[i, :lo] = 0
+            common[i, hi:] = 0
+            common[i, lo:hi] = np.interp(
+                new_dispersion[lo:hi], dispersion, values, left=0, right=0)
+    return (common_flux, common_ivar)
+
+def _mask_nonfinite(common_flux, common_ivar):
+    """
+    Zero (in place) the flux and ivar where their product is not finite,
+    and return that product with the same pixels zeroed.
+    """
+    weighted_flux = common_flux * common_ivar
+    # Bad pixels are rare, so scan the mask once and zero them by index.
+    bad = np.flatnonzero(~np.isfinite(weighted_flux))
+    common_flux.flat[bad] = 0
+    common_ivar.flat[bad] = 0
+    weighted_flux.flat[bad] = 0
+    return weighted_flux
+
+@njit(cache=True)
+def _interp_value(x, xp, fp, j):
     """
+    Linearly interpolate fp at x, given xp[j] < x < xp[j + 1], exactly as
+    np.interp does (including its handling of NaNs).
+    """
+    slope = (fp[j + 1] - fp[j])/(xp[j + 1] - xp[j])
+    y = slope*(x - xp[j]) + fp[j]
+    if np.isnan(y):
+        y = slope*(x - xp[j + 1]) + fp[j + 1]
+        if np.isnan(y) and fp[j] == fp[j + 1]:
+            y = fp[j]
+    return y
+
+
+@njit(cache=True, error_model="numpy")
+def _stitch_sums(new_dispersion, dispersions, fluxes, ivars, offsets,
+    stitched_flux):
+    """
+    Resample the orders (concatenated, with order k in offsets[k]:offsets[k+1])
+    onto the (sorted) new dispersion and sum them in one pass over each
+    order's overlap, without building (N, num_pixels) arrays.
+
+    Returns the sums of flux * ivar, ivar, flux, 1/ivar and, if the stitched
+    flux is given, of ivar * (flux - stitched_flux)**2 for every pixel. The
+    orders are added in the same sequence (and with the same zeros for
+    non-finite or missing pixels) as the arrays in `stitch` would be.
+
+    This loops over pixels, so it is only used when numba is available.
+    """
+    num_orders, num_pixels = (offsets.size - 1, new_dispersion.size)
+    sums = np.zeros((5, num_pixels))
+    covered = np.zeros(num_pixels, dtype=np.int64)
+    for k in range(num_orders):
+        xp = dispersions[offsets[k]:offsets[k + 1]]
+        fp = fluxes[offsets[k]:offsets[k + 1]]
+        wp = ivars[offsets[k]:offsets[k + 1]]
+        m = xp.size
+        if m == 0:
+            continue
+        lo = np.searchsorted(new_dispersion, xp[0])
+        hi = np.searchsorted(new_dispersion, xp[m - 1], side="right")
+        j = 0
+        for i in range(lo, hi):
+            x = new_dispersion[i]
+            while j < m - 2 and xp[j + 1] <= x:
+                j += 1
+            if x == xp[m - 1]:
+                f, w = (fp[m - 1], wp[m - 1])
+            elif xp[j] == x:
+                f, w = (fp[j], wp[j])
+            else:
+                f = _interp_value(x, xp, fp, j)
+                w = _interp_value(x, xp, wp, j)
+            if not np.isfinite(f * w):
+                f, w = (0., 0.)
+            sums[0, i] += f * w
+            sums[1, i] += w
+            sums[2, i] += f
+            sums[3, i] += 1./w
+            if stitched_flux.size > 0:
+                sums[4, i] += w * (f - stitched_flux[i])**2
+            covered[i] += 1
+
+    # Orders that miss a pixel add zero flux and ivar there (so 1/0 = inf).
+    for i in range(num_pixels):
+        if covered[i] < num_orders:
+            sums[3, i] += np.inf
+            if stitched_flux.size > 0 and not np.isfinite(stitched_flux[i]):
+                sums[4, i] = np.nan
+    return sums
+
+
+def _fused_stitch_arguments(spectra, new_dispersion, full_output, buffers,
+    dtype):
+    """
+    Return the (concatenated) arguments for `_stitch_sums`, or None if the
+    (N, num_pixels) arrays are needed or numba is unavailable.
+    """
+    if not _HAS_NUMBA or full_output or buffers is not None \
+    or np.dtype(dtype) != np.float64 or len(spectra) == 0 \
+    or not np.all(new_dispersion[1:] >= new_dispersion[:-1]):
+        return None
+    offsets = np.cumsum([0] + [s.dispersion.size for s in spectra])
+    return (np.ascontiguousarray(new_dispersion, dtype=float),
+        np.concatenate([s.dispersion for s in spectra]).astype(float),
+        np.concatenate([s.flux for s in spectra]).astype(float),
+        np.concatenate([s.ivar for s in spectra]).astype(float),
+        offsets)
+
+def _stitch_core(spectra, new_dispersion, mode, full_output=False,
+    buffers=None, dtype=np.float64):
+    """
+    Resample spectra onto a common dispersion and combine them, as done by
+    `stitch` (mode "weighted"), `stitch_weighted` ("weighted_stderr") and
+    `coadd` ("sum").
+    """
+    if mode not in ("weighted", "weighted_stderr", "sum"):
+        raise ValueError("unknown stitch mode {}".format(mode))
+
     if new_dispersion is None:
         new_dispersion = common_dispersion_map2(spectra)
-    
-    N = len(spectra)
-    common_flux = np.zeros((N, new_dispersion.size))
-    common_ivar = np.zeros((N, new_dispersion.size))
-    
-    for i, spectrum in enumerate(spectra):
-        common_flux[i, :] = np.interp(
-            new_dispersion, spectrum.dispersion, spectrum.flux,
-            left=0, right=0)
-        common_ivar[i, :] = np.interp(
-            new_dispersion, spectrum.dispersion, spectrum.ivar,
-            left=0, right=0)
 
-    finite = np.isfinite(common_flux * common_ivar)
-    common_flux[~finite] = 0
-    common_ivar[~finite] = 0
+    fused = _fused_stitch_arguments(spectra, new_dispersion, full_output,
+        buffers, dtype)
+    if fused is not None:
+        sums = _stitch_sums(*fused, np.empty(0))
 
-    numerator = np.sum(common_flux * common_ivar, axis=0)
-    denominator = np.sum(common_ivar, axis=0)
-    flux, ivar = (numerator/denominator, denominator)
-    newspec = Spectrum1D(new_dispersion, flux, ivar)
+    else:
+        common_flux, common_ivar = _resample_all(spectra, new_dispersion,
+            buffers, dtype)
+        weighted_flux = _mask_nonfinite(common_flux, common_ivar)
+
+    if mode == "sum":
+        if fused is not None:
+            flux, inverse_ivar = sums[2:4]
+        else:
+            flux = np.sum(common_flux, axis=0)
+            inverse_ivar = np.sum(1./common_ivar, axis=0)
+        with np.errstate(divide="ignore"):
+            ivar = 1./inverse_ivar
+
+    else:
+        if fused is not None:
+            numerator, denominator = sums[:2]
+        else:
+            numerator = np.sum(weighted_flux, axis=0)
+            denominator = np.sum(common_ivar, axis=0)
+        flux = numerator/denominator
+
+        if mode == "weighted":
+            ivar = denominator
+
+        else:
+            if fused is not None:
+                numerator2 = _stitch_sums(*fused, flux)[4]
+            else:
+                residual = common_flux - flux[np.newaxis,:]
+                np.square(residual, out=residual)
+                residual *= common_ivar
+                numerator2 = np.sum(residual, axis=0)
+            meansquare = numerator2/denominator
+            ivar = 1/meansquare
+
+    newspec = Spectrum1D(np.array(new_dispersion), flux, ivar)
 
     if full_output:
         return newspec, (common_flux, common_ivar)
     else:
         return newspec
 
-def stitch_weighted(spectra, new_dispersion=None, full_output=False):
+def stitch(spectra, new_dispersion=None, full_output=False,
+    buffers=None, dtype=np.float64):
+    """
+    Stitch spectra together, some of which may have overlapping dispersion
+    ranges. This is a crude (knowingly incorrect) approximation: we interpolate
+    fluxes without ensuring total conservation.
+    Even worse, we interpolate ivar, which is explicitly not conserved.
+    However the stitching is much better than before.
+
+    :param spectra:
+        A list of potentially overlapping spectra.
+
+    :param buffers: [optional]
+        A (common_flux, common_ivar) tuple of (N, new_dispersion.size) arrays
+        to reuse as work space (e.g., when calling this many times).
+
+    :param dtype: [optional]
+        The precision to resample and sum in (if no buffers are given). Using
+        `np.float32` halves the memory traffic, and the output spectrum is
+        then single precision too.
+    """
+    return _stitch_core(spectra, new_dispersion, "weighted", full_output, buffers,
+        dtype)
+
+def stitch_weighted(spectra, new_dispersion=None, full_output=False,
+    buffers=None, dtype=np.float64):
     """
     Stitch spectra together, some of which may have overlapping dispersion
     ranges. This is a crude (knowingly incorrect) approximation: we interpolate
@@ -1711,40 +2371,21 @@ def stitch_weighted(spectra, new_dispersion=None, full_output=False):
     
     :param spectra:
         A list of potentially overlapping spectra.
-    """
-    if new_dispersion is None:
-        new_dispersion = common_dispersion_map2(spectra)
-    
-    N = len(spectra)
-    common_flux = np.zeros((N, new_dispersion.size))
-    common_ivar = np.zeros((N, new_dispersion.size))
-    
-    for i, spectrum in enumerate(spectra):
-        common_flux[i, :] = np.interp(
-            new_dispersion, spectrum.dispersion, spectrum.flux,
-            left=0, right=0)
-        common_ivar[i, :] = np.interp(
-            new_dispersion, spectrum.dispersion, spectrum.ivar,
-            left=0, right=0)
 
-    finite = np.isfinite(common_flux * common_ivar)
-    common_flux[~finite] = 0
-    common_ivar[~finite] = 0
+    :param buffers: [optional]
+        A (common_flux, common_ivar) tuple of (N, new_dispersion.size) arrays
+        to reuse as work space (e.g., when calling this many times).
 
-    numerator = np.sum(common_flux * common_ivar, axis=0)
-    denominator = np.sum(common_ivar, axis=0)
-    flux = numerator/denominator
-    numerator2 = np.sum((common_flux-flux[np.newaxis,:])**2 * common_ivar, axis=0)
-    meansquare = numerator2/denominator
-    ivar = 1/meansquare
-    newspec = Spectrum1D(new_dispersion, flux, ivar)
-
-    if full_output:
-        return newspec, (common_flux, common_ivar)
-    else:
-        return newspec
+    :param dtype: [optional]
+        The precision to resample and sum in (if no buffers are given). Using
+        `np.float32` halves the memory traffic, and the output spectrum is
+        then single precision too.
+    """
+    return _stitch_core(spectra, new_dispersion, "weighted_stderr", full_output, buffers,
+        dtype)
 
-def coadd(spectra, new_dispersion=None, full_output=False):
+def coadd(spectra, new_dispersion=None, full_output=False,
+    buffers=None, dtype=np.float64):
     """
     Add spectra together (using linear interpolation to do bad rebinning).
     ivar is also interpolated and added.
@@ -1755,35 +2396,19 @@ def coadd(spectra, new_dispersion=None, full_output=False):
     
     :param spectra:
         A list of potentially overlapping spectra.
-    """
-    if new_dispersion is None:
-        new_dispersion = common_dispersion_map2(spectra)
-    
-    N = len(spectra)
-    common_flux = np.zeros((N, new_dispersion.size))
-    common_ivar = np.zeros((N, new_dispersion.size))
-    
-    for i, spectrum in enumerate(spectra):
-        common_flux[i, :] = np.interp(
-            new_dispersion, spectrum.dispersion, spectrum.flux,
-            left=0, right=0)
-        common_ivar[i, :] = np.interp(
-            new_dispersion, spectrum.dispersion, spectrum.ivar,
-            left=0, right=0)
 
-    finite = np.isfinite(common_flux * common_ivar)
-    common_flux[~finite] = 0
-    common_ivar[~finite] = 0
+    :param buffers: [optional]
+        A (common_flux, common_ivar) tuple of (N, new_dispersion.size) arrays
+        to reuse as work space (e.g., when calling this many times).
 
-    flux = np.sum(common_flux, axis=0)
-    ivar = 1./np.sum(1./common_ivar, axis=0)
-    newspec = Spectrum1D(new_dispersion, flux, ivar)
+    :param dtype: [optional]
+        The precision to resample and sum in (if no buffers are given). Using
+        `np.float32` halves the memory traffic, and the output spectrum is
+        then single precision too.
+    """
+    return _stitch_core(spectra, new_dispersion, "sum", full_output, buffers,
+        dtype)
 
-    if full_output:
-        return newspec, (common_flux, common_ivar)
-    else:
-        return newspec
-    
 
 def read_mike_spectrum(fname, fluxband=2, skip_assert=False):
     """
@@ -1807,59 +2432,45 @@ def read_mike_spectrum(fname, fluxband=2, skip_assert=False):
     """
     if not skip_assert: assert fluxband in [1,2,3,4,5,6,7]
     
-    with fits.open(fname) as hdul:
+    with fits.open(fname, memmap=True, lazy_load_hdus=True) as hdul:
         data = hdul[0].data
         header = hdul[0].header
-        metadata = OrderedDict()
-        for k, v in header.items():
-            if k in metadata:
-                metadata[k] += v
-            else:
-                metadata[k] = v
+        metadata = _header_to_metadata(header.items())
         assert metadata["CTYPE1"].upper().startswith("MULTISPE") \
             or metadata["WAT0_001"].lower() == "system=multispec"
     
     if not skip_assert: assert data.shape[0] == 7, data.shape
     
     # Get order numbers
-    order_nums = []
-    i, key_fmt = 0, "ECORD{}"
-    while key_fmt.format(i) in metadata:
-        order_nums.append(metadata[key_fmt.format(i)])
-        i += 1
+    order_nums = _numbered_values(metadata, "ECORD{}", 0)
     
     if not skip_assert: assert data.shape[1] == len(order_nums), (data.shape, len(order_nums))
     Norder = data.shape[1]
     
     Npix = data.shape[2]
     
-    # Get flux data
-    fluxes = [data[fluxband-1,iorder] for iorder in range(Norder)]
+    # Get flux data (one row per order). The data are memory mapped, so the
+    # fluxes are views and only the bands used here are read from disk.
+    fluxes = data[fluxband-1]
     # Get ivar data
     if fluxband == 2:
-        ivars = [data[2,iorder]**-2. for iorder in range(Norder)]
+        ivars = _noise_to_ivar(data[2])
     elif fluxband == 7:
-        flats = [data[1,iorder]/data[6,iorder] for iorder in range(Norder)]
-        ivars = [(flats[iorder]/data[2,iorder])**2. for iorder in range(Norder)]
+        flats = data[1]/data[6]
+        ivars = (flats/data[2])**2.
     else:
         # SNR estimate
-        snr = [estimate_snr(data[fluxband-1,iorder]) for iorder in range(Norder)]
-        ivars = [np.full(Npix, snr**2.) for snr in snr]
+        snr = np.array([estimate_snr(flux) for flux in fluxes])
+        ivars = np.repeat(snr[:, None]**2., Npix, axis=1)
         #ivars = [data[fluxband-1,iorder]**-1. for iorder in range(Norder)]
         #ivars = [np.max(np.vstack([ivar,np.zeros_like(ivar)]),axis=0) for ivar in ivars]
 
-    for ivar in ivars:
-        ivar[np.isnan(ivar)] = 0.
+    np.copyto(ivars, 0., where=np.isnan(ivars))
     
     # Join the WAT keywords for dispersion mapping.
-    i, concatenated_wat, key_fmt = (1, str(""), "WAT2_{0:03d}")
-    while key_fmt.format(i) in metadata:
-        value = metadata[key_fmt.format(i)]
-        concatenated_wat += value + (" "  * (68 - len(value)))
-        i += 1
+    concatenated_wat = _concatenate_wat(metadata)
     # Split the concatenated header into individual orders.
-    order_mapping = np.array([map(float, each.rstrip('" ').split()) \
-        for each in re.split('spec[0-9]+ ?= ?"', concatenated_wat)[1:]])
+    order_mapping = _parse_order_mapping(concatenated_wat)
     if len(order_mapping)==0:
         NAXIS1 = metadata["NAXIS1"]
         NAXIS2 = metadata["NAXIS2"]
@@ -1879,8 +2490,13 @@ def read_mike_spectrum(fname, fluxband=2, skip_assert=False):
 
 def estimate_snr(flux, window=51):
     """Use median filter and biweight scale to estimate SNR """
-    continuum = signal.medfilt(flux, window)
-    noise = biweight_scale(flux/continuum)
+    # Same as signal.medfilt (zero padded). FITS data may be big-endian,
+    # which the filter does not take.
+    flux = np.asarray(flux, dtype=flux.dtype.newbyteorder("="))
+    # (The rank filter is O(N log W), so this costs well under a millisecond
+    # per order; a first-difference MAD would be a different statistic.)
+    continuum = ndimage.median_filter(flux, size=window, mode="constant")
+    noise = biweight_scale(np.divide(flux, continuum, out=continuum))
     return 1./noise
 
 def alex_continuum_fit(spec, knot_spacing=5., Nknots=None,
@@ -1912,7 +2528,7 @@ def alex_continuum_fit(spec, knot_spacing=5., Nknots=None,
     """
     x, y, w = spec.dispersion, spec.flux, spec.ivar
     # 0th order median 
-    c0 = signal.medfilt(y, median_window)
+    c0 = ndimage.median_filter(y, size=median_window, mode="constant")
     n0 = y/c0
     w0 = w*c0*c0
     n0[np.isnan(n0)] = 0.
@@ -1933,45 +2549,52 @@ def alex_continuum_fit(spec, knot_spacing=5., Nknots=None,
     # Generate a spacing window for convolution
     spacing_window = int(knot_spacing/np.median(np.diff(x)))
     if spacing_window % 2 == 0: spacing_window += 1
-    average_filter = np.ones(spacing_window)/float(spacing_window)
     
+    # The median windowed flux does not change between iterations
+    ymedian = ndimage.median_filter(y, size=spacing_window, mode="constant")
+
     ynorm = n0.copy()
     for iter in range(maxiter):
         # Assign knot y-values from median windowing
         ixknots = np.searchsorted(x, xknots)
-        yknots = signal.medfilt(y, spacing_window)[ixknots]
+        yknots = ymedian[ixknots]
 
         # mark good pixels
         flin = interpolate.interp1d(xknots, yknots, fill_value="extrapolate")
         lincont = flin(x) #np.interp(x, xknots, yknots, left=1.0, right=1.0)
         good = np.abs((y-lincont)*np.sqrt(w)) < sigmaclip
         #logger.debug("iter{}: Found {} good points".format(iter+1, np.sum(good)))
-        # count good pixel fraction in spacing window
-        goodfrac = np.convolve(good.astype(int), average_filter, 'same')
+        # count good pixel fraction in spacing window around each knot
+        # (a running sum, as np.convolve with a box filter is O(N*window))
+        cumgood = np.concatenate([[0], np.cumsum(good)])
+        lo = np.clip(ixknots - spacing_window//2, 0, x.size)
+        hi = np.clip(ixknots + spacing_window//2 + 1, 0, x.size)
+        goodfrac = (cumgood[hi] - cumgood[lo])/float(spacing_window)
         # reject knots that have too few continuum points
-        iibadknots = goodfrac[ixknots] < knot_reject_threshold
+        iibadknots = goodfrac < knot_reject_threshold
         #logger.debug("iter{}: Rejecting {}/{} knots".format(iter+1, np.sum(iibadknots), len(iibadknots)))
         xknots = xknots[~iibadknots]
         yknots = yknots[~iibadknots]
         
         #return x, y, w, xknots, yknots, lincont, good, goodfrac
-        # Fit spline through knots
+        #if np.sum(iibadknots) == 0: break
+
+    # Fit spline through knots. Nothing in the loop depends on the spline,
+    # so it only needs to be fit once, for the final knots and good pixels.
+    if maxiter > 0:
         fnorm = interpolate.LSQUnivariateSpline(x[good], y[good], xknots, w[good], k=spline_order)
         #fnorm = interpolate.Akima1DInterpolator(xknots, yknots)
         ynorm = fnorm(x)
         #chi2 = np.nansum((y[good] - ynorm[good])**2.*w[good])/float(np.sum(good))
-        
-        #if np.sum(iibadknots) == 0: break
         #if chi2 < 1.5:
         #    logger.info("Chi2={:.2f}".format(chi2))
-        #    break
-    
+
     if full_output:
         return fnorm, ynorm, xknots, yknots, good
     return fnorm
 
 def write_fits_linear(fname, wmin, dwave, flux):
-    hdu = fits.PrimaryHDU(np.array(flux))
+    hdu = fits.PrimaryHDU(np.ascontiguousarray(flux))
     headers = {}
     headers.update({
             'CTYPE1': 'LINEAR  ',
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Helpers shared by the LESSPayne subpackages. """
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+__all__ = ["njit", "HAS_NUMBA", "num_workers"]
+
+import os
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    # numba is optional; without it the decorated kernels run as plain numpy
+    def njit(*args, **kwargs):
+        return lambda func: func
+    HAS_NUMBA = False
+
+
+def num_workers(n_jobs):
+    """
+    Return the number of worker processes for an `n_jobs` setting.
+
+    Positive values are used as they are. Negative values count back from the
+    number of cores: -1 uses all cores, -2 all but one, and so on.
+
+    :raise ValueError:
+        If `n_jobs` is 0, or so negative that no worker would be left.
+    """
+    workers = int(n_jobs)
+    if workers < 0:
+        workers += (os.cpu_count() or 1) + 1
+    if workers < 1:
+        raise ValueError("n_jobs={} leaves no worker processes".format(n_jobs))
+    return workers
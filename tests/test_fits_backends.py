@@ -0,0 +1,307 @@
+""" Tests for LESSPayne.specutils.spectrum. """
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from LESSPayne.specutils import spectrum
+
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+needs_fitsio = pytest.mark.skipif(fitsio is None, reason="fitsio is not installed")
+
+
+# The FITS readers must give the same results with and without fitsio.
+
+@pytest.fixture
+def cube_path(tmp_path):
+    data = np.arange(3 * 4 * 10, dtype=np.float32).reshape(3, 4, 10)
+    hdu = fits.PrimaryHDU(data)
+    hdu.header["BANDID1"] = "wavelength"
+    hdu.header["BANDID2"] = "flux"
+    hdu.header["BANDID3"] = "ivar"
+    hdu.header["EXPTIME"] = 600.0
+    hdu.header["NIGHT"] = 3
+    hdu.header.add_comment("first comment")
+    hdu.header.add_comment("second comment")
+    hdu.header.add_history("reduced")
+    hdu.header.add_blank("a blank card")
+    path = str(tmp_path / "cube.fits")
+    hdu.writeto(path)
+    return path
+
+
+@pytest.fixture(params=[pytest.param("fitsio", marks=needs_fitsio), "astropy"])
+def backend(request, monkeypatch):
+    if request.param == "astropy":
+        monkeypatch.setattr(spectrum, "fitsio", None)
+    return request.param
+
+
+@needs_fitsio
+def test_read_header_is_backend_independent(cube_path, monkeypatch):
+    with_fitsio = spectrum._read_header(cube_path)
+    monkeypatch.setattr(spectrum, "fitsio", None)
+    without_fitsio = spectrum._read_header(cube_path)
+    assert list(with_fitsio.items()) == list(without_fitsio.items())
+    assert with_fitsio["COMMENT"] == "first commentsecond comment"
+    assert type(with_fitsio["EXPTIME"]) is type(without_fitsio["EXPTIME"])
+
+
+@pytest.mark.parametrize("bands", [(0, 1, 2), (2, 0), (-1, )])
+def test_read_bands(cube_path, backend, bands):
+    expected = fits.getdata(cube_path)
+    data = spectrum._read_bands(cube_path, bands)
+    assert len(data) == len(bands)
+    for band, array in zip(bands, data):
+        np.testing.assert_array_equal(array, expected[band])
+
+
+@pytest.mark.parametrize("band", [3, -4])
+def test_read_bands_out_of_range(cube_path, backend, band):
+    with pytest.raises(IndexError):
+        spectrum._read_bands(cube_path, (band, ))
+
+
+def test_read_bands_from_open_hdu(cube_path, backend):
+    with fits.open(cube_path) as image:
+        data = spectrum._read_bands(cube_path, (1, ), image[0])
+        np.testing.assert_array_equal(data[0], image[0].data[1])
+
+
+def _orders(num_orders=3, num_pixels=20):
+    dispersion = 5000 + np.arange(num_orders * num_pixels, dtype=float).reshape(
+        num_orders, num_pixels)
+    flux = 1 + np.arange(num_orders * num_pixels, dtype=float).reshape(
+        num_orders, num_pixels) / 100.
+    ivar = np.full_like(flux, 4.0)
+    return dispersion, flux, ivar
+
+
+def test_spectrum_orders_are_views_of_the_arrays():
+    dispersion, flux, ivar = _orders()
+    orders = spectrum.SpectrumOrders(dispersion, flux, ivar)
+    assert len(orders) == 3
+    for name, array in zip(("dispersion", "flux", "ivar"), (dispersion, flux, ivar)):
+        stacked = getattr(orders, name)
+        np.testing.assert_array_equal(stacked, array)
+        assert np.shares_memory(stacked, array)
+        assert not stacked.flags.writeable
+        for j, order in enumerate(orders):
+            assert np.shares_memory(getattr(order, name), array[j])
+
+
+def test_spectrum_orders_run_blue_to_red():
+    dispersion, flux, ivar = _orders()
+    dispersion[1], flux[1] = dispersion[1, ::-1], flux[1, ::-1]
+    orders = spectrum.SpectrumOrders(dispersion, flux, ivar)
+    assert np.all(np.diff(orders.dispersion, axis=1) > 0)
+    np.testing.assert_array_equal(orders.flux[1], flux[1, ::-1])
+    np.testing.assert_array_equal(orders[1].flux, flux[1, ::-1])
+
+
+def test_spectrum_orders_editing_one_order():
+    dispersion, flux, ivar = _orders()
+    expected_flux = flux.copy()
+    orders = spectrum.SpectrumOrders(dispersion, flux, ivar)
+    orders[0].redshift(v=30., reinterpolate=True)
+
+    # The other orders and the caller's arrays are untouched...
+    np.testing.assert_array_equal(flux, expected_flux)
+    for j in (1, 2):
+        np.testing.assert_array_equal(orders[j].flux, expected_flux[j])
+
+    # ...and the 2D arrays are re-stacked from the current orders.
+    stacked = orders.flux
+    assert not np.shares_memory(stacked, flux)
+    assert not stacked.flags.writeable
+    np.testing.assert_array_equal(stacked[0], orders[0].flux)
+    np.testing.assert_array_equal(stacked[1:], expected_flux[1:])
+    assert np.shares_memory(orders.dispersion, dispersion)
+
+
+def test_spectrum_orders_after_list_changes():
+    dispersion, flux, ivar = _orders()
+    orders = spectrum.SpectrumOrders(dispersion, flux, ivar)
+    del orders[1]
+    np.testing.assert_array_equal(orders.flux, flux[[0, 2]])
+    orders.append(orders[0].copy())
+    np.testing.assert_array_equal(orders.flux, flux[[0, 2, 0]])
+
+
+def test_spectrum_orders_placeholder_ivar():
+    dispersion, flux, ivar = _orders()
+    ivar[1] = 0
+    orders = spectrum.SpectrumOrders(dispersion, flux, ivar)
+    assert np.all(ivar[1] == 0)
+    np.testing.assert_allclose(orders.ivar[1], 1.0 / np.mean(flux[1]))
+    np.testing.assert_array_equal(orders.ivar[[0, 2]], ivar[[0, 2]])
+    assert orders[1].ivar is not ivar[1]
+    assert np.shares_memory(orders[1].ivar, orders.ivar)
+
+
+@pytest.mark.parametrize("shapes,expected", [
+    (((3, 20), (3, 20), (3, 20)), True),
+    (((2, 2), (2, 2), (2, 2)), True),
+    (((1, 20), (1, 20), (1, 20)), False),
+    (((3, 1), (3, 1), (3, 1)), False),
+    (((3, 20), (3, 20), (3, 19)), False),
+    (((60, ), (60, ), (60, )), False),
+])
+def test_spectrum_orders_can_hold(shapes, expected):
+    arrays = [np.ones(shape) for shape in shapes]
+    assert spectrum.SpectrumOrders.can_hold(*arrays) is expected
+
+
+def test_spectrum_orders_can_hold_lists():
+    dispersion, flux, ivar = _orders()
+    assert not spectrum.SpectrumOrders.can_hold(dispersion.tolist(), flux, ivar)
+
+
+def _rebin_reference(new_dispersion, dispersion, flux, ivar, fill_value):
+    # Pixel by pixel overlaps, as in SpectRes
+    old_edges = spectrum._bin_edges(dispersion)
+    new_edges = spectrum._bin_edges(new_dispersion)
+    new_flux = np.full(new_dispersion.size, float(fill_value))
+    new_ivar = np.full(new_dispersion.size, float(fill_value))
+    for j, (start, end) in enumerate(zip(new_edges[:-1], new_edges[1:])):
+        if start < old_edges[0] or end >= old_edges[-1]:
+            continue
+        overlap = np.clip(np.minimum(old_edges[1:], end) \
+            - np.maximum(old_edges[:-1], start), 0, None)
+        used = overlap > 0
+        if np.all(np.isfinite(flux[used])):
+            new_flux[j] = np.sum(overlap[used] * flux[used]) / (end - start)
+        else:
+            new_flux[j] = np.nan
+        if np.all(ivar[used] > 0):
+            new_ivar[j] = (end - start)**2 / np.sum(overlap[used]**2 / ivar[used])
+        else:
+            new_ivar[j] = 0
+    return new_flux, new_ivar
+
+
+@pytest.mark.parametrize("step", [0.37, 1.0, 2.5])
+def test_linterpolate_flux_conserving(step):
+    rng = np.random.default_rng(2)
+    dispersion = 5000 + np.cumsum(rng.uniform(0.05, 0.15, 400))
+    flux = rng.uniform(0.5, 1.5, dispersion.size)
+    ivar = rng.uniform(10, 100, dispersion.size)
+    flux[100] = np.nan
+    ivar[200] = 0
+    old = spectrum.Spectrum1D(dispersion, flux, ivar)
+    new_dispersion = np.arange(4999, 5050, step)
+
+    new = old.linterpolate(new_dispersion, fill_value=-1, flux_conserving=True)
+    expected_flux, expected_ivar = _rebin_reference(new_dispersion, dispersion,
+        flux, ivar, -1)
+    np.testing.assert_allclose(new.flux, expected_flux, rtol=1e-10)
+    np.testing.assert_allclose(new.ivar, expected_ivar, rtol=1e-10)
+    assert np.isnan(new.flux).any() and (new.ivar == 0).any()
+
+    # A flat spectrum stays flat wherever it is covered
+    flat = spectrum.Spectrum1D(dispersion, np.full_like(flux, 2.), ivar)
+    new = flat.linterpolate(new_dispersion, fill_value=-1, flux_conserving=True)
+    covered = new.flux != -1
+    assert covered.sum() > 10
+    np.testing.assert_allclose(new.flux[covered], 2.)
+
+
+def test_linterpolate_default_is_linear():
+    dispersion = np.linspace(5000, 5010, 101)
+    flux, ivar = np.sin(dispersion), np.cos(dispersion)**2 + 1
+    new_dispersion = np.linspace(4999, 5011, 57)
+    new = spectrum.Spectrum1D(dispersion, flux, ivar).linterpolate(new_dispersion)
+    np.testing.assert_array_equal(new.flux,
+        np.interp(new_dispersion, dispersion, flux, left=0, right=0))
+    np.testing.assert_array_equal(new.ivar,
+        np.interp(new_dispersion, dispersion, ivar, left=0, right=0))
+    assert not np.shares_memory(new.dispersion, new_dispersion)
+
+
+def _nonlinear_dispersion(function_type, order, coefficients, num_pixels=2048.):
+    # As parsed from a WAT2 string, so the numbers arrive as floats
+    return spectrum.compute_dispersion(1., 1., 2., 4000., 0.1, num_pixels,
+        0., 0., 0., 1., 0., float(function_type), float(order), 1.,
+        num_pixels, *coefficients)
+
+
+@pytest.mark.parametrize("function_type,series", [
+    (1, np.polynomial.chebyshev.chebval),
+    (2, np.polynomial.legendre.legval),
+])
+def test_compute_dispersion_polynomials(function_type, series):
+    coefficients = [4500., 480., -3.2, 0.41, -0.05]
+    dispersion = _nonlinear_dispersion(function_type, len(coefficients),
+        coefficients + [99.])
+    x = np.linspace(-1, 1, 2048)
+    assert dispersion.shape == (2048, )
+    np.testing.assert_allclose(dispersion, series(x, coefficients), rtol=1e-12)
+
+
+@pytest.mark.parametrize("order", [1, 4])
+def test_compute_dispersion_cubic_spline(order):
+    from scipy.interpolate import BSpline
+    rng = np.random.default_rng(order)
+    coefficients = 4000 + np.cumsum(rng.uniform(50, 100, order + 3))
+    dispersion = _nonlinear_dispersion(3, order, list(coefficients) + [99.])
+
+    # IRAF's spline3 basis is six times the uniform cubic B-spline basis
+    s = np.arange(2048) / 2047. * order
+    spline = BSpline(np.arange(-3, order + 4, dtype=float), 6 * coefficients, 3)
+    np.testing.assert_allclose(dispersion, spline(s), rtol=1e-12)
+
+    if order == 1:
+        # The single piece case is unchanged from the old basis matrix
+        a, b = 1 - s, s
+        basis = np.array([a**3, 1 + 3*a*(1 + a*b), 1 + 3*b*(1 + a*b), b**3])
+        np.testing.assert_allclose(dispersion, np.dot(coefficients, basis),
+            rtol=1e-12)
+
+
+def _blaze(noise=0.):
+    dispersion = np.linspace(5000, 5100, 3000)
+    t = (dispersion - 5050) / 50.
+    continuum = 1000 * np.sinc((dispersion - 5045) / 60.)**2 \
+        * (1 + 0.1*t - 0.05*t**2)
+    rng = np.random.default_rng(0)
+    flux = continuum * (1 + noise * rng.standard_normal(dispersion.size))
+    return spectrum.Spectrum1D(dispersion, flux, np.ones_like(flux)), continuum
+
+
+@pytest.mark.parametrize("noise,rtol", [(0., 1e-10), (0.003, 1e-2)])
+def test_fit_continuum_polysinc(noise, rtol):
+    # (the old finite-difference fit recovered these to 2e-13 and 5.5e-3)
+    blaze, expected = _blaze(noise)
+    normalized, continuum, left, right = blaze.fit_continuum(
+        function="polysinc", order=3, max_iterations=1,
+        low_sigma_clip=10, high_sigma_clip=10, full_output=True)
+    np.testing.assert_allclose(continuum[left:right], expected[left:right],
+        rtol=rtol)
+    np.testing.assert_allclose(normalized.flux * continuum[left:right],
+        blaze.flux[left:right])
+
+
+def test_line_exclude_masks():
+    run_eqw_fit = pytest.importorskip("LESSPayne.autosmh.run_eqw_fit",
+        exc_type=ImportError)
+    regions = [[5001., 5002.], [4999.5, 5000.5], [4990., 4995.], [5004., 5010.],
+               [4996., 4996.5], [5005.5, 5006.]]
+    masks = run_eqw_fit._line_exclude_masks(regions, [5000., 5005.], [4., 1.])
+    # Regions containing the line center are no longer kept
+    assert masks[0] == [[4996., 4996.5], [5001., 5002.]]
+    assert masks[1] == [[5005.5, 5006.]]
+
+    rng = np.random.default_rng(3)
+    starts = rng.uniform(4000, 6000, 500)
+    regions = np.column_stack([starts, starts + rng.uniform(0, 5, starts.size)])
+    wavelengths = rng.uniform(4000, 6000, 200)
+    windows = rng.uniform(0.5, 3, wavelengths.size)
+    masks = run_eqw_fit._line_exclude_masks(regions, wavelengths, windows)
+    for w0, window, mask in zip(wavelengths, windows, masks):
+        expected = [list(x) for x in regions if (x[1] > w0 - window \
+            and x[0] < w0 + window) and not (w0 > x[0] and w0 < x[1])]
+        assert sorted(mask) == sorted(expected)